@@ -3,20 +3,28 @@
 """
 import os
 import logging
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 from dataclasses import dataclass
 
 import yaml
-from dotenv import load_dotenv
 
-# 加载环境变量
-load_dotenv()
+try:
+    # libyaml C 实现，比纯 Python 解析快约一个数量级
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 # 项目根目录
 ROOT_DIR = Path(__file__).parent.parent
 CONFIG_FILE = ROOT_DIR / "config.yaml"
 
+# 加载环境变量（仅在存在 .env 文件或设置 USE_DOTENV 时导入 python-dotenv）
+if os.getenv('USE_DOTENV') or any((d / '.env').exists() for d in (Path(__file__).parent, ROOT_DIR)):
+    from dotenv import load_dotenv
+    load_dotenv()
+
 
 @dataclass
 class NotesConfig:
@@ -32,6 +40,9 @@ class EmbeddingConfig:
     model: str
     batch_size: int
     dimension: int
+    assume_normalized: bool = False  # 服务端返回的向量已是单位向量时跳过归一化
+    query_batch_size: int = 0  # 并发查询合批上限（<=1 表示关闭合批）
+    query_flush_interval_ms: float = 10.0  # 合批等待窗口（毫秒）
 
 
 @dataclass
@@ -97,7 +108,7 @@ class Settings:
     def __init__(self):
         # 加载 YAML 配置
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YamlLoader)
         
         # 笔记配置
         notes_dir = os.getenv('NOTES_DIRECTORY', config['notes']['directory'])
@@ -111,7 +122,10 @@ class Settings:
             api_base=config['embedding']['api_base'],
             model=config['embedding']['model'],
             batch_size=config['embedding']['batch_size'],
-            dimension=config['embedding']['dimension']
+            dimension=config['embedding']['dimension'],
+            assume_normalized=config['embedding'].get('assume_normalized', False),
+            query_batch_size=config['embedding'].get('query_batch_size', 0),
+            query_flush_interval_ms=config['embedding'].get('query_flush_interval_ms', 10.0)
         )
         
         # LLM 配置
@@ -175,8 +189,14 @@ class Settings:
         self.storage.cache_dir.mkdir(exist_ok=True)
 
 
+@lru_cache(maxsize=1)
+def load_settings() -> Settings:
+    """加载全局配置（进程内只解析一次）"""
+    return Settings()
+
+
 # 全局配置实例
-settings = Settings()
+settings = load_settings()
 
 # 日志配置
 logging.basicConfig(
@@ -1,7 +1,21 @@
 """
 数据库模块
+
+子模块按需导入（PEP 562），避免仅使用 MetadataStore 时也加载 faiss
 """
-from .metadata_store import MetadataStore
-from .vector_store import VectorStore
+from importlib import import_module
+
+_EXPORTS = {
+    'MetadataStore': '.metadata_store',
+    'VectorStore': '.vector_store',
+}
+
+__all__ = list(_EXPORTS)
+
 
-__all__ = ['MetadataStore', 'VectorStore']
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
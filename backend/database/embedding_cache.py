@@ -3,38 +3,123 @@
 用于缓存已计算的向量，避免重复调用 API
 """
 import hashlib
-import aiosqlite
-from typing import List, Optional
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence
 from pathlib import Path
 
+import aiosqlite
+import numpy as np
+from cachetools import LRUCache
+
+try:
+    from blake3 import blake3 as _hasher
+    _HAS_BLAKE3 = True
+except ImportError:
+    # 未安装 blake3 时退回标准库 blake2b
+    _hasher = hashlib.blake2b
+    _HAS_BLAKE3 = False
+
 from config import settings, logger
+from database.sqlite_utils import apply_pragmas
+
+
+# 热路径 SQL 固定为模块常量，保证 sqlite3 语句缓存命中
+# 批量查询固定占位符数量（不足时以 NULL 填充），使 SQL 形状与批次大小无关
+_LOOKUP_BATCH = 256
+
+_SELECT_ONE_SQL = """
+    SELECT embedding, dtype FROM embedding_cache
+    WHERE content_hash = ? AND model = ?
+"""
+
+_SELECT_BATCH_SQL = f"""
+    SELECT content_hash, embedding, dtype FROM embedding_cache
+    WHERE content_hash IN ({','.join(['?'] * _LOOKUP_BATCH)}) AND model = ?
+"""
+
+# 原地更新冲突行（INSERT OR REPLACE 会先删除再插入，多一次 B 树操作）
+_UPSERT_SQL = """
+    INSERT INTO embedding_cache (content_hash, model, embedding, dtype)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (content_hash, model) DO UPDATE
+    SET embedding = excluded.embedding, dtype = excluded.dtype
+"""
+
+# 批量模式：写入先落在内存暂存库 stage，结束时一次性合并到主表
+_STAGE_SELECT_BATCH_SQL = _SELECT_BATCH_SQL.replace("FROM embedding_cache", "FROM stage.embedding_cache")
+_STAGE_UPSERT_SQL = _UPSERT_SQL.replace("INTO embedding_cache", "INTO stage.embedding_cache")
+_STAGE_MERGE_SQL = """
+    INSERT OR REPLACE INTO main.embedding_cache (content_hash, model, embedding, dtype, created_at)
+    SELECT content_hash, model, embedding, dtype, created_at FROM stage.embedding_cache
+"""
+
+
+@lru_cache(maxsize=16384)
+def _content_hash(text: str) -> bytes:
+    """计算文本的 16 字节二进制摘要（重试/重建索引时命中进程内缓存）"""
+    return _hasher(text.encode('utf-8')).digest()[:16]
+
+
+# 标准库 hashlib 对 >2KB 的输入会释放 GIL，大批量时用线程池并行计算摘要
+_PARALLEL_HASH_MIN = 512
+_hash_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _content_hashes(texts: Sequence[str]) -> List[bytes]:
+    """批量计算文本摘要"""
+    global _hash_executor
+    
+    if _HAS_BLAKE3 or len(texts) < _PARALLEL_HASH_MIN:
+        return list(map(_content_hash, texts))
+    
+    if _hash_executor is None:
+        _hash_executor = ThreadPoolExecutor(thread_name_prefix="embedding-hash")
+    return list(_hash_executor.map(_content_hash, texts, chunksize=64))
 
 
 class EmbeddingCache:
     """向量化缓存管理"""
     
+    # 进程内 LRU 容量（条目数），命中时跳过 SQLite 查询
+    MEMORY_CACHE_SIZE = 10_000
+    # 磁盘存储精度：float16 使每条记录减半，余弦检索对该精度损失不敏感
+    STORAGE_DTYPE = np.dtype(np.float16)
+    
     def __init__(self, cache_path: Optional[Path] = None):
         self.cache_path = cache_path or Path(settings.storage.data_dir) / "embedding_cache.db"
         self.conn: Optional[aiosqlite.Connection] = None
+        # (content_hash, model) -> float32 向量
+        self._memory = LRUCache(maxsize=self.MEMORY_CACHE_SIZE)
+        # 是否处于批量写入模式（begin_bulk/commit_bulk 之间）
+        self._bulk = False
     
     async def initialize(self):
         """初始化缓存数据库"""
         self.cache_path.parent.mkdir(parents=True, exist_ok=True)
         self.conn = await aiosqlite.connect(str(self.cache_path))
+        await apply_pragmas(self.conn)
         await self._create_table()
     
     async def _create_table(self):
         """创建缓存表"""
         await self.conn.execute("""
             CREATE TABLE IF NOT EXISTS embedding_cache (
-                content_hash TEXT NOT NULL,
+                content_hash BLOB NOT NULL,
                 model TEXT NOT NULL,
                 embedding BLOB NOT NULL,
+                dtype TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 PRIMARY KEY (content_hash, model)
             )
         """)
         
+        # 旧版缓存表没有 dtype 列（NULL 视为 float32）
+        columns = await self.conn.execute_fetchall("PRAGMA table_info(embedding_cache)")
+        if 'dtype' not in {column[1] for column in columns}:
+            await self.conn.execute("ALTER TABLE embedding_cache ADD COLUMN dtype TEXT")
+        
         # 创建索引加速查询
         await self.conn.execute("""
             CREATE INDEX IF NOT EXISTS idx_cache_lookup 
@@ -43,11 +128,69 @@ class EmbeddingCache:
         
         await self.conn.commit()
     
-    def _compute_hash(self, text: str) -> str:
+    async def begin_bulk(self):
+        """
+        进入批量写入模式
+        
+        挂载内存数据库 stage，之后的 set/set_batch 写入 stage，
+        索引构建的内层循环不再触发磁盘 fsync
+        """
+        if self._bulk:
+            return
+        
+        await self.conn.execute("ATTACH DATABASE ':memory:' AS stage")
+        await self.conn.execute("""
+            CREATE TABLE stage.embedding_cache (
+                content_hash BLOB NOT NULL,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                dtype TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (content_hash, model)
+            )
+        """)
+        self._bulk = True
+    
+    async def commit_bulk(self):
+        """退出批量写入模式：将 stage 中的数据在单个事务内合并到主表"""
+        if not self._bulk:
+            return
+        
+        await self.conn.execute(_STAGE_MERGE_SQL)
+        await self.conn.commit()
+        await self.conn.execute("DETACH DATABASE stage")
+        self._bulk = False
+    
+    def _compute_hash(self, text: str) -> bytes:
         """计算文本哈希"""
-        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return _content_hash(text)
+    
+    def _encode(self, embedding) -> np.ndarray:
+        """转换为存储精度（返回值即写入磁盘的数组）"""
+        return np.asarray(embedding, dtype=np.float32).astype(self.STORAGE_DTYPE)
     
-    async def get(self, text: str, model: str) -> Optional[List[float]]:
+    @staticmethod
+    def _decode(blob, dtype: Optional[str] = None) -> np.ndarray:
+        """原始字节反序列化为 float32 向量（兼容旧版 JSON 文本格式与无 dtype 的 float32 记录）"""
+        if isinstance(blob, str):
+            return np.asarray(json.loads(blob), dtype=np.float32)
+        return np.frombuffer(blob, dtype=dtype or np.float32).astype(np.float32, copy=False)
+    
+    @classmethod
+    def _decode_many(cls, blobs: List, dtypes: List[Optional[str]]) -> List[np.ndarray]:
+        """
+        批量反序列化：同精度等长字节块拼接后一次 frombuffer，各行为矩阵的视图
+        """
+        if blobs and all(
+            isinstance(b, bytes) and len(b) == len(blobs[0]) and d == dtypes[0]
+            for b, d in zip(blobs, dtypes)
+        ):
+            matrix = np.frombuffer(b''.join(blobs), dtype=dtypes[0] or np.float32)
+            matrix = matrix.astype(np.float32, copy=False)
+            return list(matrix.reshape(len(blobs), -1))
+        return [cls._decode(b, d) for b, d in zip(blobs, dtypes)]
+    
+    async def get(self, text: str, model: str) -> Optional[np.ndarray]:
         """
         从缓存获取向量
         
@@ -56,26 +199,26 @@ class EmbeddingCache:
             model: 模型名称
         
         Returns:
-            向量列表，如果缓存不存在则返回 None
+            float32 向量，如果缓存不存在则返回 None
         """
         content_hash = self._compute_hash(text)
         
-        cursor = await self.conn.execute("""
-            SELECT embedding FROM embedding_cache
-            WHERE content_hash = ? AND model = ?
-        """, (content_hash, model))
+        key = (content_hash, model)
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            return embedding
         
-        row = await cursor.fetchone()
+        # execute_fetchall 只经过一次 aiosqlite 工作线程往返
+        rows = await self.conn.execute_fetchall(_SELECT_ONE_SQL, (content_hash, model))
         
-        if row:
-            # 将 BLOB 反序列化为 float 列表
-            import json
-            embedding = json.loads(row[0])
+        if rows:
+            embedding = self._decode(rows[0][0], rows[0][1])
+            self._memory[key] = embedding
             return embedding
         
         return None
     
-    async def get_batch(self, texts: List[str], model: str) -> List[Optional[List[float]]]:
+    async def get_batch(self, texts: List[str], model: str) -> List[Optional[np.ndarray]]:
         """
         批量获取缓存向量
         
@@ -86,25 +229,48 @@ class EmbeddingCache:
         Returns:
             向量列表，未命中的位置为 None
         """
-        hashes = [self._compute_hash(text) for text in texts]
+        hashes = _content_hashes(texts)
         
-        # 批量查询
-        placeholders = ','.join(['?'] * len(hashes))
-        cursor = await self.conn.execute(f"""
-            SELECT content_hash, embedding FROM embedding_cache
-            WHERE content_hash IN ({placeholders}) AND model = ?
-        """, (*hashes, model))
+        # 先查进程内缓存，只对未命中的哈希查询数据库（重复文本只查一次）
+        cache_map = {}
+        missing = []
+        for h in dict.fromkeys(hashes):
+            embedding = self._memory.get((h, model))
+            if embedding is not None:
+                cache_map[h] = embedding
+            else:
+                missing.append(h)
         
-        rows = await cursor.fetchall()
+        rows = await self._fetch_rows(_SELECT_BATCH_SQL, missing, model)
+        
+        # 批量模式下，主表未命中的再查暂存库
+        if self._bulk and len(rows) < len(missing):
+            found = {row[0] for row in rows}
+            rows.extend(await self._fetch_rows(
+                _STAGE_SELECT_BATCH_SQL, [h for h in missing if h not in found], model
+            ))
+        
+        # 工作线程只返回原始字节，反序列化在此批量完成
+        embeddings = self._decode_many([row[1] for row in rows], [row[2] for row in rows])
         
         # 构建哈希到向量的映射
-        import json
-        cache_map = {row[0]: json.loads(row[1]) for row in rows}
+        for (content_hash, _, _), embedding in zip(rows, embeddings):
+            cache_map[content_hash] = embedding
+            self._memory[(content_hash, model)] = embedding
         
         # 返回按原顺序排列的结果
         return [cache_map.get(h) for h in hashes]
     
-    async def set(self, text: str, model: str, embedding: List[float]):
+    async def _fetch_rows(self, sql: str, hashes: List[bytes], model: str) -> List:
+        """批量查询（按固定大小分组，末组以 None 填充）"""
+        rows = []
+        for i in range(0, len(hashes), _LOOKUP_BATCH):
+            group = hashes[i:i + _LOOKUP_BATCH]
+            group += [None] * (_LOOKUP_BATCH - len(group))
+            rows.extend(await self.conn.execute_fetchall(sql, (*group, model)))
+        return rows
+    
+    async def set(self, text: str, model: str, embedding: Sequence[float]):
         """
         存储向量到缓存
         
@@ -113,17 +279,19 @@ class EmbeddingCache:
             model: 模型名称
             embedding: 向量
         """
-        import json
         content_hash = self._compute_hash(text)
+        stored = self._encode(embedding)
         
-        await self.conn.execute("""
-            INSERT OR REPLACE INTO embedding_cache (content_hash, model, embedding)
-            VALUES (?, ?, ?)
-        """, (content_hash, model, json.dumps(embedding)))
+        upsert_sql = _STAGE_UPSERT_SQL if self._bulk else _UPSERT_SQL
+        await self.conn.execute(
+            upsert_sql, (content_hash, model, stored.tobytes(), stored.dtype.name)
+        )
         
         await self.conn.commit()
+        # 进程内缓存与磁盘精度一致，命中路径不同时结果相同
+        self._memory[(content_hash, model)] = stored.astype(np.float32)
     
-    async def set_batch(self, texts: List[str], model: str, embeddings: List[List[float]]):
+    async def set_batch(self, texts: List[str], model: str, embeddings: Sequence[Sequence[float]]):
         """
         批量存储向量到缓存
         
@@ -132,19 +300,21 @@ class EmbeddingCache:
             model: 模型名称
             embeddings: 向量列表
         """
-        import json
-        
+        # 重复文本合并为一次写入（与逐条 upsert 一致，保留最后一次的向量）
+        unique = dict(zip(_content_hashes(texts), embeddings))
+        stored = {h: self._encode(emb) for h, emb in unique.items()}
         data = [
-            (self._compute_hash(text), model, json.dumps(emb))
-            for text, emb in zip(texts, embeddings)
+            (content_hash, model, vector.tobytes(), vector.dtype.name)
+            for content_hash, vector in stored.items()
         ]
         
-        await self.conn.executemany("""
-            INSERT OR REPLACE INTO embedding_cache (content_hash, model, embedding)
-            VALUES (?, ?, ?)
-        """, data)
+        upsert_sql = _STAGE_UPSERT_SQL if self._bulk else _UPSERT_SQL
+        await self.conn.executemany(upsert_sql, data)
         
         await self.conn.commit()
+        
+        for content_hash, vector in stored.items():
+            self._memory[(content_hash, model)] = vector.astype(np.float32)
     
     async def get_stats(self) -> dict:
         """获取缓存统计信息"""
@@ -166,14 +336,18 @@ class EmbeddingCache:
         """
         if model:
             await self.conn.execute("DELETE FROM embedding_cache WHERE model = ?", (model,))
+            for key in [k for k in self._memory if k[1] == model]:
+                del self._memory[key]
         else:
             await self.conn.execute("DELETE FROM embedding_cache")
+            self._memory.clear()
         
         await self.conn.commit()
     
     async def close(self):
         """关闭连接"""
         if self.conn:
+            await self.commit_bulk()
             await self.conn.close()
 
 
@@ -193,7 +367,8 @@ async def test_cache():
     
     # 读取
     cached = await cache.get(text, model)
-    assert cached == embedding, "缓存数据不匹配"
+    # 磁盘以 float16 存储，按 float16 精度比较
+    assert np.allclose(cached, embedding, atol=1e-3), "缓存数据不匹配"
     
     # 测试批量缓存
     texts = ["文本1", "文本2", "文本3"]
@@ -202,14 +377,14 @@ async def test_cache():
     await cache.set_batch(texts, model, embeddings)
     
     cached_batch = await cache.get_batch(texts, model)
-    assert all(c == e for c, e in zip(cached_batch, embeddings)), "批量缓存数据不匹配"
+    assert all(np.allclose(c, e, atol=1e-3) for c, e in zip(cached_batch, embeddings)), "批量缓存数据不匹配"
     
     # 测试部分命中
     mixed_texts = ["文本1", "新文本", "文本3"]
     mixed_results = await cache.get_batch(mixed_texts, model)
-    assert mixed_results[0] == embeddings[0], "第1个应命中"
+    assert np.allclose(mixed_results[0], embeddings[0], atol=1e-3), "第1个应命中"
     assert mixed_results[1] is None, "第2个应未命中"
-    assert mixed_results[2] == embeddings[2], "第3个应命中"
+    assert np.allclose(mixed_results[2], embeddings[2], atol=1e-3), "第3个应命中"
     
     # 统计
     stats = await cache.get_stats()
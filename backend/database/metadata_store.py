@@ -2,11 +2,56 @@
 元数据存储（SQLite）
 """
 import aiosqlite
-from datetime import datetime
-from typing import List, Dict, Optional
+import orjson
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 
 from config import settings, logger
+from database.sqlite_utils import apply_pragmas
+
+
+# 热路径 SQL 固定为模块常量，保证 sqlite3 语句缓存命中
+_INSERT_CHUNK_SQL = """
+    INSERT OR REPLACE INTO chunks
+    (chunk_id, doc_id, content, chunk_index, start_pos, end_pos)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+_INSERT_DOCUMENT_SQL = """
+    INSERT OR REPLACE INTO documents
+    (doc_id, file_path, title, created_at, modified_at, content_hash, metadata)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+_INSERT_TAG_SQL = "INSERT INTO tags (doc_id, tag_name) VALUES (?, ?)"
+_DELETE_TAGS_SQL = "DELETE FROM tags WHERE doc_id = ?"
+_DELETE_BACKLINKS_SQL = "DELETE FROM backlinks WHERE source_doc_id = ?"
+_INSERT_BACKLINK_SQL = "INSERT INTO backlinks (source_doc_id, target_page) VALUES (?, ?)"
+# 显式列出字段，排序与 idx_chunks_doc_index 一致，查询计划中无需额外排序
+_SELECT_CHUNKS_BY_DOC_SQL = """
+    SELECT chunk_id, doc_id, content, chunk_index, start_pos, end_pos
+    FROM chunks WHERE doc_id = ? ORDER BY chunk_index
+"""
+_SELECT_CHUNK_WINDOW_SQL = """
+    SELECT content FROM chunks
+    WHERE doc_id = ? AND chunk_index BETWEEN ? AND ?
+    ORDER BY chunk_index
+"""
+# 批量查询固定占位符数量（不足时以 NULL 填充），使 SQL 形状与批次大小无关
+_LOOKUP_BATCH = 256
+_IN_PLACEHOLDERS = ','.join(['?'] * _LOOKUP_BATCH)
+_SELECT_CHUNKS_BY_IDS_SQL = f"SELECT chunk_id, content FROM chunks WHERE chunk_id IN ({_IN_PLACEHOLDERS})"
+# 文档信息连同标签、双链一次取回（相关子查询各自走索引，避免 JOIN 产生笛卡尔积）
+_SELECT_DOCUMENTS_WITH_LINKS_SQL = f"""
+    SELECT d.doc_id, d.file_path, d.title, d.created_at, d.modified_at,
+           (SELECT group_concat(tag_name, char(31)) FROM tags WHERE doc_id = d.doc_id),
+           (SELECT group_concat(target_page, char(31)) FROM backlinks WHERE source_doc_id = d.doc_id)
+    FROM documents d WHERE d.doc_id IN ({_IN_PLACEHOLDERS})
+"""
+_GROUP_SEPARATOR = '\x1f'  # group_concat 分隔符（char(31)），不会出现在标签或页面名中
+_SELECT_DOCS_BY_TAG_SQL = "SELECT DISTINCT doc_id FROM tags WHERE tag_name = ?"
+_SELECT_BACKLINKED_DOCS_SQL = "SELECT DISTINCT source_doc_id FROM backlinks WHERE target_page = ?"
+
+# frontmatter 可能包含 numpy 数值或非字符串键
+_METADATA_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
 
 
 class MetadataStore:
@@ -19,6 +64,7 @@ class MetadataStore:
     async def initialize(self):
         """初始化数据库"""
         self.conn = await aiosqlite.connect(self.db_path)
+        await apply_pragmas(self.conn)
         await self._create_tables()
         logger.info(f"✅ 元数据数据库初始化完成: {self.db_path}")
     
@@ -72,6 +118,7 @@ class MetadataStore:
         
         # 创建索引
         await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id)")
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc_index ON chunks(doc_id, chunk_index)")
         await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_doc ON tags(doc_id)")
         await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_name ON tags(tag_name)")
         await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_backlinks_source ON backlinks(source_doc_id)")
@@ -79,67 +126,38 @@ class MetadataStore:
         
         await self.conn.commit()
     
-    async def insert_document(self, doc_id: str, file_path: str, title: str, 
-                             created_at: datetime, modified_at: datetime, 
-                             content_hash: str, metadata: dict):
-        """插入文档"""
-        import json
-        from datetime import datetime as dt
-        
-        # 递归转换 metadata 中的 datetime 对象为 ISO 字符串
-        def serialize_datetime(obj):
-            if isinstance(obj, dt):
-                return obj.isoformat()
-            elif isinstance(obj, dict):
-                return {k: serialize_datetime(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [serialize_datetime(item) for item in obj]
-            return obj
-        
-        serialized_metadata = serialize_datetime(metadata)
-        
-        await self.conn.execute("""
-            INSERT OR REPLACE INTO documents 
-            (doc_id, file_path, title, created_at, modified_at, content_hash, metadata)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (doc_id, file_path, title, created_at, modified_at, content_hash, json.dumps(serialized_metadata)))
-        
-        await self.conn.commit()
+    @staticmethod
+    def serialize_metadata(metadata: dict) -> str:
+        """序列化文档元数据"""
+        # orjson 原生序列化 datetime/date（ISO 格式），无需 Python 层递归转换
+        return orjson.dumps(metadata, option=_METADATA_JSON_OPTIONS).decode()
     
-    async def insert_chunk(self, chunk_id: str, doc_id: str, content: str,
-                          chunk_index: int, start_pos: int, end_pos: int):
-        """插入分块"""
-        await self.conn.execute("""
-            INSERT OR REPLACE INTO chunks
-            (chunk_id, doc_id, content, chunk_index, start_pos, end_pos)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (chunk_id, doc_id, content, chunk_index, start_pos, end_pos))
-        await self.conn.commit()
-    
-    async def insert_tags(self, doc_id: str, tags: List[str]):
-        """插入标签"""
-        # 先删除旧标签
-        await self.conn.execute("DELETE FROM tags WHERE doc_id = ?", (doc_id,))
+    async def bulk_store(self, documents: List[Tuple], tags: List[Tuple],
+                         backlinks: List[Tuple], chunks: List[Tuple]):
+        """
+        单个事务内批量写入文档、标签、双链和分块（每张表一次 executemany）
         
-        # 插入新标签
-        for tag in tags:
-            await self.conn.execute(
-                "INSERT INTO tags (doc_id, tag_name) VALUES (?, ?)",
-                (doc_id, tag)
-            )
-        await self.conn.commit()
-    
-    async def insert_backlinks(self, doc_id: str, backlinks: List[str]):
-        """插入双链"""
-        # 先删除旧双链
-        await self.conn.execute("DELETE FROM backlinks WHERE source_doc_id = ?", (doc_id,))
+        Args:
+            documents: [(doc_id, file_path, title, created_at, modified_at, content_hash, metadata_json), ...]
+            tags: [(doc_id, tag_name), ...]
+            backlinks: [(source_doc_id, target_page), ...]
+            chunks: [(chunk_id, doc_id, content, chunk_index, start_pos, end_pos), ...]
+        """
+        doc_ids = [(row[0],) for row in documents]
+        
+        try:
+            # 先清除这些文档的旧标签/双链
+            await self.conn.executemany(_DELETE_TAGS_SQL, doc_ids)
+            await self.conn.executemany(_DELETE_BACKLINKS_SQL, doc_ids)
+            
+            await self.conn.executemany(_INSERT_DOCUMENT_SQL, documents)
+            await self.conn.executemany(_INSERT_TAG_SQL, tags)
+            await self.conn.executemany(_INSERT_BACKLINK_SQL, backlinks)
+            await self.conn.executemany(_INSERT_CHUNK_SQL, chunks)
+        except Exception:
+            await self.conn.rollback()
+            raise
         
-        # 插入新双链
-        for target in backlinks:
-            await self.conn.execute(
-                "INSERT INTO backlinks (source_doc_id, target_page) VALUES (?, ?)",
-                (doc_id, target)
-            )
         await self.conn.commit()
     
     async def get_document_by_path(self, file_path: str) -> Optional[Dict]:
@@ -165,10 +183,7 @@ class MetadataStore:
     
     async def get_chunks_by_doc(self, doc_id: str) -> List[Dict]:
         """获取文档的所有分块"""
-        cursor = await self.conn.execute(
-            "SELECT * FROM chunks WHERE doc_id = ? ORDER BY chunk_index",
-            (doc_id,)
-        )
+        cursor = await self.conn.execute(_SELECT_CHUNKS_BY_DOC_SQL, (doc_id,))
         rows = await cursor.fetchall()
         
         return [
@@ -183,21 +198,50 @@ class MetadataStore:
             for row in rows
         ]
     
+    async def get_chunk_window(self, doc_id: str, start: int, end: int) -> List[str]:
+        """获取文档中 chunk_index 位于 [start, end] 的分块内容（按顺序，单次查询）"""
+        rows = await self.conn.execute_fetchall(_SELECT_CHUNK_WINDOW_SQL, (doc_id, start, end))
+        return [row[0] for row in rows]
+    
+    async def _fetch_in(self, sql: str, keys: List[str]) -> List[Tuple]:
+        """执行 IN 列表查询（按固定大小分组，末组以 None 填充）"""
+        rows = []
+        for i in range(0, len(keys), _LOOKUP_BATCH):
+            group = keys[i:i + _LOOKUP_BATCH]
+            group += [None] * (_LOOKUP_BATCH - len(group))
+            rows.extend(await self.conn.execute_fetchall(sql, group))
+        return rows
+    
+    async def get_chunk_contents(self, chunk_ids: List[str]) -> Dict[str, str]:
+        """批量获取分块内容：{chunk_id: content}，不存在的 ID 不出现在结果中"""
+        return dict(await self._fetch_in(_SELECT_CHUNKS_BY_IDS_SQL, chunk_ids))
+    
+    async def get_documents_with_links(self, doc_ids: List[str]) -> Dict[str, Tuple]:
+        """
+        批量获取文档信息及其标签、双链（单次查询）
+        
+        Returns:
+            {doc_id: (file_path, title, created_at, modified_at, [tag, ...], [target_page, ...])}
+        """
+        rows = await self._fetch_in(_SELECT_DOCUMENTS_WITH_LINKS_SQL, doc_ids)
+        return {
+            doc_id: (
+                file_path, title, created_at, modified_at,
+                tags.split(_GROUP_SEPARATOR) if tags else [],
+                backlinks.split(_GROUP_SEPARATOR) if backlinks else []
+            )
+            for doc_id, file_path, title, created_at, modified_at, tags, backlinks in rows
+        }
+    
     async def get_documents_by_tag(self, tag_name: str) -> List[str]:
         """根据标签获取文档ID列表"""
-        cursor = await self.conn.execute(
-            "SELECT DISTINCT doc_id FROM tags WHERE tag_name = ?",
-            (tag_name,)
-        )
+        cursor = await self.conn.execute(_SELECT_DOCS_BY_TAG_SQL, (tag_name,))
         rows = await cursor.fetchall()
         return [row[0] for row in rows]
     
     async def get_backlinked_documents(self, target_page: str) -> List[str]:
         """获取引用了指定页面的文档列表"""
-        cursor = await self.conn.execute(
-            "SELECT DISTINCT source_doc_id FROM backlinks WHERE target_page = ?",
-            (target_page,)
-        )
+        cursor = await self.conn.execute(_SELECT_BACKLINKED_DOCS_SQL, (target_page,))
         rows = await cursor.fetchall()
         return [row[0] for row in rows]
     
@@ -0,0 +1,26 @@
+"""
+SQLite 连接调优
+"""
+import aiosqlite
+
+
+# 每个连接初始化时执行的 PRAGMA
+# - WAL：写入时读操作不阻塞
+# - synchronous=NORMAL：WAL 模式下减少每次提交的 fsync
+# - cache_size=-65536：64MB 页缓存
+# - mmap_size：256MB 内存映射读取
+# - busy_timeout：避免并发访问时立即抛出 SQLITE_BUSY
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+async def apply_pragmas(conn: aiosqlite.Connection):
+    """对连接应用性能相关的 PRAGMA"""
+    for pragma in CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
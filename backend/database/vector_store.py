@@ -2,11 +2,13 @@
 向量存储（FAISS）
 """
 import pickle
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, TYPE_CHECKING
 from pathlib import Path
 
 import numpy as np
-import faiss
+
+if TYPE_CHECKING:
+    import faiss
 
 from config import settings, logger
 from models import DocumentChunk
@@ -15,39 +17,148 @@ from models import DocumentChunk
 class VectorStore:
     """FAISS 向量数据库"""
     
+    # 向量数低于该值时使用精确检索（暴力扫描），否则使用 HNSW 近似检索
+    HNSW_MIN_VECTORS = 5000
+    HNSW_M = 32
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH_MIN = 64
+    # 8-bit 标量量化：每维 1 字节，检索时内存带宽降为 fp32 的 1/4
+    # （faiss 在首次建索引/加载时才导入，这里只记录量化类型名）
+    SQ_TYPE = 'QT_8bit'
+    # 量化参数（每维取值范围）的训练样本数：应从整个语料随机抽取，见 train()
+    SQ_TRAIN_SAMPLE = 2000
+    
     def __init__(self):
         self.index_path = settings.storage.vector_index
         self.dimension = settings.embedding.dimension
+        self.assume_normalized = settings.embedding.assume_normalized
+        
+        self.index: Optional['faiss.Index'] = None
+        self.chunk_ids: List[str] = []  # 整数 ID -> chunk_id 映射（ID 即列表下标）
+        # 从磁盘加载时改用内存映射的字符串表，按需解码
+        self._ids_blob: Optional[np.ndarray] = None
+        self._ids_offsets: Optional[np.ndarray] = None
+    
+    @property
+    def ids_blob_path(self) -> Path:
+        """chunk_id 字符串表（UTF-8 拼接）"""
+        return self.index_path.with_suffix('.ids.bin')
+    
+    @property
+    def ids_offset_path(self) -> Path:
+        """chunk_id 字符串表偏移量（uint64，共 N+1 项）"""
+        return self.index_path.with_suffix('.ids.off')
+    
+    def _chunk_id(self, idx: int) -> Optional[str]:
+        """整数 ID -> chunk_id（越界返回 None）"""
+        if self._ids_offsets is None:
+            return self.chunk_ids[idx] if idx < len(self.chunk_ids) else None
+        if idx + 1 >= len(self._ids_offsets):
+            return None
+        start, end = int(self._ids_offsets[idx]), int(self._ids_offsets[idx + 1])
+        return self._ids_blob[start:end].tobytes().decode('utf-8')
+    
+    @staticmethod
+    def _memmap(path: Path, dtype) -> np.ndarray:
+        """只读内存映射（空文件无法映射，直接返回空数组）"""
+        if path.stat().st_size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+    
+    def _hnsw(self):
+        """返回底层 HNSW 结构（非 HNSW 索引返回 None）"""
+        import faiss
         
-        self.index: Optional[faiss.Index] = None
-        self.chunk_ids: List[str] = []  # chunk_id 映射
+        base = self.index.index if isinstance(self.index, faiss.IndexIDMap) else self.index
+        return getattr(faiss.downcast_index(base), 'hnsw', None)
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray):
+        """L2 归一化（原地进行，einsum 单遍计算行范数）"""
+        norms = np.einsum('ij,ij->i', vectors, vectors)
+        np.sqrt(norms, out=norms)
+        norms[norms == 0] = 1.0  # 零向量保持不变
+        vectors /= norms[:, None]
     
-    def create_index(self):
-        """创建新索引"""
+    def create_index(self, expected_size: int = 0):
+        """
+        创建新索引
+        
+        Args:
+            expected_size: 预计写入的向量数，用于选择索引类型
+        """
+        import faiss
+        
+        sq_type = getattr(faiss.ScalarQuantizer, self.SQ_TYPE)
+        
         # 使用 Inner Product (IP) 相似度
         # 注意：需要对向量进行归一化
-        self.index = faiss.IndexFlatIP(self.dimension)
+        # 向量以 8-bit 标量量化存储，首次添加时训练量化参数
+        if expected_size >= self.HNSW_MIN_VECTORS:
+            # 大规模语料：HNSW 图检索，查询复杂度从 O(N) 降至约 O(log N)
+            base = faiss.IndexHNSWSQ(
+                self.dimension, sq_type, self.HNSW_M, faiss.METRIC_INNER_PRODUCT
+            )
+            base.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+            index_type = "HNSW-SQ8"
+        else:
+            base = faiss.IndexScalarQuantizer(
+                self.dimension, sq_type, faiss.METRIC_INNER_PRODUCT
+            )
+            index_type = "SQ8"
+        
+        # IDMap2 直接在索引中记录 int64 ID，检索结果即为 chunk_ids 下标
+        self.index = faiss.IndexIDMap2(base)
+        self._base_index = base  # 保持引用，避免底层索引被回收
         self.chunk_ids = []
-        logger.info(f"✅ 创建新的 FAISS 索引 (维度: {self.dimension})")
+        self._ids_blob = self._ids_offsets = None
+        logger.info(f"✅ 创建新的 FAISS 索引 (类型: {index_type}, 维度: {self.dimension})")
+    
+    @property
+    def needs_training(self) -> bool:
+        """索引是否尚未训练量化参数"""
+        return self.index is not None and not self.index.is_trained
+    
+    def train(self, vectors: np.ndarray):
+        """
+        用样本训练量化参数（已训练时忽略）
+        
+        样本需代表整个语料：只用首批向量训练时，未出现在样本中的簇会被截断到错误的取值范围，
+        相似度分数整体偏移
+        """
+        if not self.needs_training:
+            return
+        
+        vectors = np.array(vectors, dtype=np.float32)  # 复制，归一化不影响调用方
+        if not self.assume_normalized:
+            self._normalize(vectors)
+        self.index.train(vectors)
     
-    def add_vectors(self, chunks: List[DocumentChunk]):
+    def add_vectors(self, chunks: List[DocumentChunk], vectors: np.ndarray):
         """
         添加向量到索引
         
         Args:
-            chunks: 包含 embedding 的分块列表
+            chunks: 分块列表
+            vectors: (N, dimension) float32 矩阵，第 i 行对应 chunks[i]
         """
         if not chunks:
             return
         
-        # 提取向量
-        vectors = np.array([chunk.embedding for chunk in chunks], dtype=np.float32)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
         
-        # L2 归一化（用于 Inner Product）
-        faiss.normalize_L2(vectors)
+        # L2 归一化（用于 Inner Product）；服务端已返回单位向量时跳过
+        if not self.assume_normalized:
+            self._normalize(vectors)
         
-        # 添加到索引
-        self.index.add(vectors)
+        # 调用方未先 train() 时退回用本批向量训练（样本可能不具代表性）
+        if not self.index.is_trained:
+            self.index.train(vectors)
+        
+        # 添加到索引（ID 连续递增）
+        start_id = len(self.chunk_ids)
+        ids = np.arange(start_id, start_id + len(chunks), dtype=np.int64)
+        self.index.add_with_ids(vectors, ids)
         
         # 记录 chunk_id 映射
         self.chunk_ids.extend([chunk.chunk_id for chunk in chunks])
@@ -71,7 +182,12 @@ class VectorStore:
         
         # 归一化查询向量
         query = np.array([query_vector], dtype=np.float32)
-        faiss.normalize_L2(query)
+        self._normalize(query)
+        
+        # HNSW 检索宽度随 top_k 调整，保证召回率
+        hnsw = self._hnsw()
+        if hnsw is not None:
+            hnsw.efSearch = max(self.HNSW_EF_SEARCH_MIN, top_k * 4)
         
         # 检索
         scores, indices = self.index.search(query, min(top_k, self.index.ntotal))
@@ -79,8 +195,11 @@ class VectorStore:
         # 构建结果
         results = []
         for score, idx in zip(scores[0], indices[0]):
-            if idx != -1 and idx < len(self.chunk_ids):
-                results.append((self.chunk_ids[idx], float(score)))
+            if idx == -1:
+                continue
+            chunk_id = self._chunk_id(int(idx))
+            if chunk_id is not None:
+                results.append((chunk_id, float(score)))
         
         return results
     
@@ -90,13 +209,17 @@ class VectorStore:
             logger.warning("索引未初始化，跳过保存")
             return
         
+        import faiss
+        
         # 保存 FAISS 索引
         faiss.write_index(self.index, str(self.index_path))
         
-        # 保存 chunk_id 映射
-        mapping_path = self.index_path.with_suffix('.pkl')
-        with open(mapping_path, 'wb') as f:
-            pickle.dump(self.chunk_ids, f)
+        # 保存 chunk_id 字符串表（二进制，无需 pickle）
+        encoded = [chunk_id.encode('utf-8') for chunk_id in self.chunk_ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        self.ids_blob_path.write_bytes(b''.join(encoded))
+        offsets.tofile(self.ids_offset_path)
         
         logger.info(f"✅ 索引已保存: {self.index_path}")
     
@@ -106,13 +229,29 @@ class VectorStore:
             logger.warning(f"索引文件不存在: {self.index_path}")
             return False
         
-        # 加载 FAISS 索引
-        self.index = faiss.read_index(str(self.index_path))
+        import faiss
+        
+        # 加载 FAISS 索引（只读内存映射，由页缓存按需载入，启动时不整体读入内存）
+        try:
+            self.index = faiss.read_index(
+                str(self.index_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            )
+        except RuntimeError:
+            # 旧版 FAISS 不支持对该索引类型做 mmap
+            self.index = faiss.read_index(str(self.index_path))
         
         # 加载 chunk_id 映射
-        mapping_path = self.index_path.with_suffix('.pkl')
-        with open(mapping_path, 'rb') as f:
-            self.chunk_ids = pickle.load(f)
+        self.chunk_ids = []
+        if self.ids_offset_path.exists():
+            self._ids_blob = self._memmap(self.ids_blob_path, np.uint8)
+            self._ids_offsets = self._memmap(self.ids_offset_path, np.uint64)
+        else:
+            self._ids_blob = self._ids_offsets = None
+            # 兼容旧版 pickle 映射（无 IDMap，检索下标即列表下标）
+            mapping_path = self.index_path.with_suffix('.pkl')
+            with open(mapping_path, 'rb') as f:
+                self.chunk_ids = pickle.load(f)
+            logger.warning("⚠️ 使用旧版 chunk_id 映射文件，建议重建索引")
         
         logger.info(f"✅ 索引已加载: {self.index_path} (共 {self.index.ntotal} 个向量)")
         return True
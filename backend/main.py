@@ -2,25 +2,98 @@
 AI Digital - 智能笔记检索系统
 FastAPI 主入口
 """
+import os
 import sys
+import asyncio
+from dataclasses import fields
 from pathlib import Path
 from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
+import orjson
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from dotenv import load_dotenv
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 # 添加项目根目录到 Python 路径
 sys.path.insert(0, str(Path(__file__).parent))
 
 from services.indexer import IndexerService
 from services.retriever import RetrieverService
+from services.llm import LLMService
 from config import settings, logger
 
-# 加载环境变量
-load_dotenv()
+# SSE 帧前后缀（预编码为 bytes）
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+
+def sse_event(payload: dict) -> bytes:
+    """将事件序列化为一帧 SSE（orjson 直接输出 UTF-8 bytes）"""
+    return SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
+
+
+# SSE 合并写出：缓冲达到字节数或首帧等待超时即发送，小帧不再各自触发一次写入
+SSE_FLUSH_BYTES = 512
+SSE_FLUSH_SECONDS = 0.05
+_STREAM_END = object()
+
+
+async def batch_sse_frames(frames: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    合并相邻的 SSE 帧后写出（每帧仍是完整的 data 事件，前端解析不受影响）
+    
+    帧由后台任务读入队列，缓冲中的首帧最多等待 SSE_FLUSH_SECONDS，延迟有上界
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    async def _produce():
+        try:
+            async for frame in frames:
+                queue.put_nowait(frame)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(_STREAM_END)
+    
+    producer = asyncio.create_task(_produce())
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    deadline = None
+    error = None
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+                continue
+            
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                error = item
+                break
+            
+            if not buffer:
+                deadline = loop.time() + SSE_FLUSH_SECONDS
+            buffer += item
+            if len(buffer) >= SSE_FLUSH_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+                deadline = None
+        
+        if buffer:
+            yield bytes(buffer)
+        if error is not None:
+            raise error
+    finally:
+        # 客户端断开时停止上游生成
+        producer.cancel()
 
 
 @asynccontextmanager
@@ -28,9 +101,10 @@ async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     logger.info("🚀 启动 AI Digital 后端服务...")
     
-    # 初始化索引服务
+    # 初始化索引服务（LLM 与向量化客户端全局共享，复用连接池）
     app.state.indexer = IndexerService()
-    app.state.retriever = RetrieverService(app.state.indexer)
+    app.state.llm = LLMService()
+    app.state.retriever = RetrieverService(app.state.indexer, llm=app.state.llm)
     
     # 检查是否需要构建索引
     if not app.state.indexer.is_index_exists():
@@ -45,7 +119,9 @@ async def lifespan(app: FastAPI):
     
     # 关闭服务
     logger.info("🛑 关闭服务...")
+    await app.state.retriever.close()
     await app.state.indexer.close()
+    await app.state.llm.close()
 
 
 # 创建 FastAPI 应用
@@ -103,11 +179,16 @@ async def search(query: str, local_ratio: float = 0.8):
         retriever = app.state.retriever
         results = await retriever.hybrid_search(query, local_ratio)
         
-        return {
-            "query": query,
-            "results": results,
-            "total": len(results)
-        }
+        # orjson 原生序列化 dataclass 与 datetime，跳过逐条构建字典和 FastAPI 的二次编码
+        body = orjson.dumps(
+            {
+                "query": query,
+                "results": results,
+                "total": len(results)
+            },
+            option=orjson.OPT_SERIALIZE_DATACLASS
+        )
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         logger.error(f"搜索失败: {str(e)}")
         return JSONResponse(
@@ -125,13 +206,7 @@ async def chat_stream(query: str, local_ratio: float = 0.8):
         query: 用户问题
         local_ratio: 本地结果占比
     """
-    from fastapi.responses import StreamingResponse
-    
     async def event_generator():
-        # 必须在函数开头导入！
-        import json
-        from config import logger
-        
         retriever = app.state.retriever
         
         logger.info(f"🔍 收到查询请求: '{query}' (local_ratio={local_ratio})")
@@ -143,33 +218,49 @@ async def chat_stream(query: str, local_ratio: float = 0.8):
         
         logger.info(f"📊 检索策略: 本地={local_k}条, 网络={network_k}条 (总计={total_results})")
         
-        # Step 1: 工具调用 - 本地检索
+        # Step 1: 工具调用 - 本地检索与网络搜索并发执行（总耗时取两者较大值）
+        local_task = None
+        web_task = None
+        
         if local_k > 0:
             logger.info(f"🔎 开始本地检索 (top_k={local_k})")
-            yield f'data: {json.dumps({"type": "tool_call", "tool": "local_search", "status": "running"})}\n\n'
-            local_results = await retriever.local_search(query, top_k=local_k)
-            logger.info(f"✅ 本地检索完成: {len(local_results)}条结果")
-            # 打印前 5 条本地召回结果，包含内容与元数据预览（使用属性访问）
-            logger.info(
-                f"🔍 本地召回结果示例: "
-                f"{[{'content': r.content[:50], 'metadata': {k: v for k, v in r.to_dict().items() if k != 'content'}} for r in local_results[:5]]}"
-            )
-
-            yield f'data: {json.dumps({"type": "tool_call", "tool": "local_search", "status": "completed", "count": len(local_results)})}\n\n'
+            local_task = asyncio.create_task(retriever.local_search(query, top_k=local_k))
+            yield sse_event({"type": "tool_call", "tool": "local_search", "status": "running"})
         else:
             logger.info("⏭️  跳过本地检索 (local_k=0)")
-            local_results = []
         
-        # Step 2: 工具调用 - 网络搜索
         if network_k > 0:
             logger.info(f"🌐 开始网络搜索 (top_k={network_k})")
-            yield f'data: {json.dumps({"type": "tool_call", "tool": "web_search", "status": "running"})}\n\n'
-            web_results = await retriever.web_search_async(query, top_k=network_k)
-            logger.info(f"✅ 网络搜索完成: {len(web_results)}条结果")
-            yield f'data: {json.dumps({"type": "tool_call", "tool": "web_search", "status": "completed", "count": len(web_results)})}\n\n'
+            web_task = asyncio.create_task(retriever.web_search_async(query, top_k=network_k))
+            yield sse_event({"type": "tool_call", "tool": "web_search", "status": "running"})
         else:
             logger.info("⏭️  跳过网络搜索 (network_k=0)")
-            web_results = []
+        
+        # Step 2: 等待检索完成
+        pending = [task for task in (local_task, web_task) if task is not None]
+        try:
+            await asyncio.gather(*pending)
+        finally:
+            # 客户端断开或出错时取消未完成的任务
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+        
+        local_results = local_task.result() if local_task else []
+        web_results = web_task.result() if web_task else []
+        
+        if local_task:
+            logger.info(f"✅ 本地检索完成: {len(local_results)}条结果")
+            # 打印前 5 条本地召回结果，包含内容与元数据预览（使用属性访问）
+            logger.info(
+                f"🔍 本地召回结果示例: "
+                f"{[{'content': r.content[:50], 'metadata': {f.name: getattr(r, f.name) for f in fields(r) if f.name != 'content'}} for r in local_results[:5]]}"
+            )
+            yield sse_event({"type": "tool_call", "tool": "local_search", "status": "completed", "count": len(local_results)})
+        
+        if web_task:
+            logger.info(f"✅ 网络搜索完成: {len(web_results)}条结果")
+            yield sse_event({"type": "tool_call", "tool": "web_search", "status": "completed", "count": len(web_results)})
         
         # Step 3: 合并结果
         all_results = local_results + web_results
@@ -180,19 +271,19 @@ async def chat_stream(query: str, local_ratio: float = 0.8):
         async for chunk in retriever.format_answer(query, all_results):
             # 直接发送 LLM 生成的文本片段
             if chunk:
-                yield f'data: {json.dumps({"type": "text", "content": chunk}, ensure_ascii=False)}\n\n'
+                yield sse_event({"type": "text", "content": chunk})
         
         # Step 5: 发送引用
         citations = retriever.format_citations(all_results)
         logger.info(f"📚 发送引用数据: {len(citations)}个来源")
-        yield f'data: {json.dumps({"type": "citations", "data": citations}, ensure_ascii=False)}\n\n'
+        yield sse_event({"type": "citations", "data": citations})
         
         # Step 6: 结束标记
         logger.info("✅ 流式响应完成")
-        yield f'data: {json.dumps({"type": "done"})}\n\n'
+        yield sse_event({"type": "done"})
     
     return StreamingResponse(
-        event_generator(),
+        batch_sse_frames(event_generator()),
         media_type="text/event-stream"
     )
 
@@ -203,6 +294,7 @@ async def rebuild_index():
     try:
         indexer = app.state.indexer
         await indexer.build_index()
+        app.state.retriever.clear_answer_cache()
         return {"status": "success", "message": "索引重建完成"}
     except Exception as e:
         logger.error(f"索引重建失败: {str(e)}")
@@ -213,10 +305,14 @@ async def rebuild_index():
 
 
 if __name__ == "__main__":
+    # uvloop + httptools（uvicorn[standard] 已包含）降低 SSE 小包写入的事件循环开销
+    # 热重载仅用于开发：UVICORN_RELOAD=1 python main.py
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=settings.server.backend_port,
-        reload=True,
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+        reload=os.getenv("UVICORN_RELOAD") == "1",
         log_level="info"
     )
@@ -7,7 +7,7 @@ from typing import List, Dict, Optional
 from pathlib import Path
 
 
-@dataclass
+@dataclass(slots=True)
 class Document:
     """文档对象"""
     file_path: Path
@@ -18,6 +18,7 @@ class Document:
     tags: List[str] = field(default_factory=list)
     backlinks: List[str] = field(default_factory=list)  # 双链引用 [[page]]
     metadata: Dict = field(default_factory=dict)
+    doc_id: Optional[str] = None  # 解析时计算一次，分块与存储阶段复用
     
     @property
     def file_name(self) -> str:
@@ -29,16 +30,15 @@ class Document:
         return str(self.file_path)
 
 
-@dataclass
+@dataclass(slots=True)
 class DocumentChunk:
-    """文档分块"""
+    """文档分块（向量不随分块保存，由向量化结果矩阵按行对应）"""
     chunk_id: str
     document_id: str
     content: str
     chunk_index: int
     start_pos: int
     end_pos: int
-    embedding: Optional[List[float]] = None
     
     # 从父文档继承的元数据
     file_path: str = ""
@@ -49,9 +49,9 @@ class DocumentChunk:
     modified_at: Optional[datetime] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SearchResult:
-    """检索结果"""
+    """检索结果（接口层由 orjson 直接序列化）"""
     content: str
     file_path: str
     title: str
@@ -62,18 +62,3 @@ class SearchResult:
     backlinks: List[str] = field(default_factory=list)
     created_at: Optional[datetime] = None
     url: Optional[str] = None  # 网络来源的 URL
-    
-    def to_dict(self) -> Dict:
-        """转换为字典"""
-        return {
-            "content": self.content,
-            "file_path": self.file_path,
-            "title": self.title,
-            "score": self.score,
-            "source": self.source,
-            "chunk_id": self.chunk_id,
-            "tags": self.tags,
-            "backlinks": self.backlinks,
-            "created_at": self.created_at.isoformat() if self.created_at else None,
-            "url": self.url
-        }
@@ -3,10 +3,19 @@
 调用 AI Builders Embedding API
 """
 import asyncio
-from typing import List
+import random
+from typing import Dict, List, Optional, Tuple
 
 import httpx
-from tqdm import tqdm
+import numpy as np
+import orjson
+from tqdm.asyncio import tqdm as async_tqdm
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
 
 from config import settings, logger
 from database.embedding_cache import EmbeddingCache
@@ -26,6 +35,18 @@ class EmbedderService:
         self.cache = EmbeddingCache()
         self._cache_initialized = False
         
+        # 查询合批：并发的 embed_query 在短窗口内合并为一次 API 请求
+        self.query_batch_size = settings.embedding.query_batch_size
+        self.query_flush_interval = settings.embedding.query_flush_interval_ms / 1000
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._query_pending = asyncio.Event()  # 队列非空
+        self._query_full = asyncio.Event()     # 队列已达合批上限
+        self._batcher_task: Optional[asyncio.Task] = None
+        
+        # 限流冷却：任一批次遇到 429 时清除，冷却结束后再放行所有并发批次
+        self._rate_limit_clear = asyncio.Event()
+        self._rate_limit_clear.set()
+        
         # 分离连接/读写超时，避免大响应体超时
         timeout_config = httpx.Timeout(
             connect=30.0,   # 连接超时：30 秒
@@ -34,6 +55,8 @@ class EmbedderService:
             pool=10.0       # 连接池超时：10 秒
         )
         
+        # 未显式设置 Accept-Encoding：httpx 会按已安装的解码器自动声明
+        # （安装 brotli 后包含 br，向量 JSON 压缩率明显高于 gzip）
         self.client = httpx.AsyncClient(
             base_url=self.api_base,
             headers={
@@ -41,10 +64,32 @@ class EmbedderService:
                 "Content-Type": "application/json"
             },
             timeout=timeout_config,  # 使用分离的超时配置
-            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            # HTTP/2 在单个连接上复用并发批次，只需一次 TLS 握手，所需连接数更少
+            http2=HTTP2_ENABLED,
+            limits=(
+                httpx.Limits(max_connections=4, max_keepalive_connections=4)
+                if HTTP2_ENABLED else
+                httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
         )
     
-    async def embed_texts(self, texts: List[str], show_progress: bool = True) -> List[List[float]]:
+    async def _ensure_cache(self):
+        """确保缓存已初始化"""
+        if not self._cache_initialized:
+            await self.cache.initialize()
+            self._cache_initialized = True
+    
+    async def begin_bulk(self):
+        """进入批量模式：缓存写入暂存在内存中，结束时统一落盘"""
+        await self._ensure_cache()
+        await self.cache.begin_bulk()
+    
+    async def commit_bulk(self):
+        """退出批量模式：将暂存的缓存一次性写入磁盘"""
+        if self._cache_initialized:
+            await self.cache.commit_bulk()
+    
+    async def embed_texts(self, texts: List[str], show_progress: bool = True) -> List[np.ndarray]:
         """
         批量向量化文本（并发版本 + 缓存）
         
@@ -53,52 +98,73 @@ class EmbedderService:
             show_progress: 是否显示进度条
         
         Returns:
-            向量列表
+            向量列表（float32 行向量）
         """
-        # 确保缓存已初始化
-        if not self._cache_initialized:
-            await self.cache.initialize()
-            self._cache_initialized = True
+        return list(await self.embed_texts_np(texts, show_progress=show_progress))
+    
+    async def embed_texts_np(self, texts: List[str], show_progress: bool = True) -> np.ndarray:
+        """
+        批量向量化文本，直接返回连续的 (N, dimension) float32 矩阵
+        
+        Args:
+            texts: 文本列表
+            show_progress: 是否显示进度条
+        
+        Returns:
+            向量矩阵，行顺序与 texts 一致
+        """
+        await self._ensure_cache()
+        
+        # 同一次调用内的重复文本（模板、免责声明等）只请求一次，最后按映射展开
+        unique_map: Dict[str, int] = {}
+        row_for_text = [unique_map.setdefault(text, len(unique_map)) for text in texts]
+        if len(unique_map) < len(texts):
+            logger.info(f"📋 去重后待向量化文本: {len(unique_map)}/{len(texts)}")
+            unique = await self.embed_texts_np(list(unique_map), show_progress=show_progress)
+            return unique[np.asarray(row_for_text, dtype=np.intp)]
         
-        all_embeddings = []
+        # 按长度降序排列后再分批，同批文本长度相近，减少服务端填充浪费
+        # argsort 在 C 层完成排序，避免逐元素调用 Python key 函数
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        order = np.argsort(-lengths, kind='stable')
+        sorted_texts = [texts[i] for i in order]
         
         # 分批处理
-        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        batches = [
+            sorted_texts[i:i + self.batch_size]
+            for i in range(0, len(sorted_texts), self.batch_size)
+        ]
         
         # 并发参数（从配置读取）
         max_concurrent = getattr(settings.embedding, 'max_concurrent', 6)
         semaphore = asyncio.Semaphore(max_concurrent)
         
-        async def embed_with_semaphore(batch, batch_idx):
+        async def embed_with_semaphore(batch):
             """带信号量的向量化（含缓存逻辑）"""
             async with semaphore:
-                embeddings = await self._embed_batch_with_cache(batch)
-                return batch_idx, embeddings
+                return await self._embed_batch_with_cache(batch)
         
         # 创建并发任务
-        tasks = [embed_with_semaphore(batch, i) for i, batch in enumerate(batches)]
+        tasks = [embed_with_semaphore(batch) for batch in batches]
         
-        # 执行并发请求
+        # 执行并发请求（gather 保持批次顺序，无需额外排序）
         if show_progress:
-            results = []
-            with tqdm(total=len(batches), desc="向量化") as pbar:
-                for coro in asyncio.as_completed(tasks):
-                    result = await coro
-                    results.append(result)
-                    pbar.update(1)
+            results = await async_tqdm.gather(*tasks, desc="向量化", total=len(batches))
         else:
             results = await asyncio.gather(*tasks)
         
-        # 按批次顺序排序
-        results.sort(key=lambda x: x[0])
+        if not results:
+            return np.empty((0, self.dimension), dtype=np.float32)
         
-        # 展平嵌套列表
-        for _, embeddings in results:
-            all_embeddings.extend(embeddings)
+        # 按批次写回输入顺序对应的行
+        matrix = np.empty((len(texts), results[0].shape[1]), dtype=np.float32)
+        for batch_idx, embeddings in enumerate(results):
+            start = batch_idx * self.batch_size
+            matrix[order[start:start + len(embeddings)]] = embeddings
         
-        return all_embeddings
+        return matrix
     
-    async def _embed_batch(self, texts: List[str], max_retries: int = 3) -> List[List[float]]:
+    async def _embed_batch(self, texts: List[str], max_retries: int = 3) -> np.ndarray:
         """
         向量化单个批次（带重试机制）
         
@@ -107,9 +173,11 @@ class EmbedderService:
             max_retries: 最大重试次数
         
         Returns:
-            向量列表
+            (len(texts), dimension) float32 矩阵
         """
         for attempt in range(max_retries):
+            # 其他批次触发限流时，等待冷却结束再发请求
+            await self._rate_limit_clear.wait()
             try:
                 logger.debug(f"发送 API 请求: {len(texts)} 个文本 (尝试 {attempt+1}/{max_retries})")
                 response = await self.client.post(
@@ -122,23 +190,24 @@ class EmbedderService:
                 )
                 response.raise_for_status()
                 
-                result = response.json()
+                result = orjson.loads(response.content)
                 
-                # 提取向量（按 index 排序）
-                embeddings_data = sorted(result['data'], key=lambda x: x['index'])
-                embeddings = [item['embedding'] for item in embeddings_data]
+                # 按 index 直接写入预分配矩阵（无需排序）
+                data = result['data']
+                embeddings = np.empty((len(data), len(data[0]['embedding'])), dtype=np.float32)
+                for item in data:
+                    embeddings[item['index']] = item['embedding']
                 
                 logger.debug(f"✅ 成功获取 {len(embeddings)} 个向量")
                 return embeddings
             
             except httpx.HTTPStatusError as e:
                 if e.response.status_code == 429:  # Rate limit
-                    wait_time = (attempt + 1) * 5  # 指数退避：5s, 10s, 15s
-                    logger.warning(f"⚠️ 触发速率限制，等待 {wait_time}s 后重试...")
-                    await asyncio.sleep(wait_time)
+                    await self._rate_limit_cooldown(e.response, attempt)
                     continue
                 logger.error(f"❌ API 请求失败: {e.response.status_code}")
-                logger.error(f"响应内容: {e.response.text[:200]}")
+                # 只解码前 200 字节，避免整段错误响应体被解码
+                logger.error(f"响应内容: {e.response.content[:200].decode('utf-8', errors='replace')}")
                 if attempt == max_retries - 1:
                     raise
             except httpx.TimeoutException as e:
@@ -148,14 +217,40 @@ class EmbedderService:
                     raise
                 await asyncio.sleep(2)
             except Exception as e:
-                logger.error(f"❌ 向量化失败: {type(e).__name__}: {str(e)}")
+                logger.error(f"❌ 向量化失败: {e!r}")
                 if attempt == max_retries - 1:
                     raise
                 await asyncio.sleep(1)
         
         raise RuntimeError(f"向量化失败，已重试 {max_retries} 次")
     
-    async def _embed_batch_with_cache(self, texts: List[str]) -> List[List[float]]:
+    @staticmethod
+    def _retry_after(response: httpx.Response, attempt: int) -> float:
+        """限流等待时间：优先使用 Retry-After 头（秒），否则线性退避 5s, 10s, 15s"""
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return (attempt + 1) * 5
+    
+    async def _rate_limit_cooldown(self, response: httpx.Response, attempt: int):
+        """
+        429 冷却：首个遇到限流的批次负责计时，其余批次等待同一冷却窗口
+        
+        冷却结束后各批次再随机错开 0~1s，避免同时重试再次触发限流
+        """
+        if self._rate_limit_clear.is_set():
+            wait_time = self._retry_after(response, attempt)
+            logger.warning(f"⚠️ 触发速率限制，等待 {wait_time:.1f}s 后重试...")
+            self._rate_limit_clear.clear()
+            try:
+                await asyncio.sleep(wait_time)
+            finally:
+                self._rate_limit_clear.set()
+        else:
+            await self._rate_limit_clear.wait()
+        await asyncio.sleep(random.uniform(0, 1.0))
+    
+    async def _embed_batch_with_cache(self, texts: List[str]) -> np.ndarray:
         """
         带缓存的批量向量化
         
@@ -163,7 +258,7 @@ class EmbedderService:
             texts: 文本列表
         
         Returns:
-            向量列表
+            (len(texts), dimension) float32 矩阵
         """
         # 1. 尝试从缓存获取
         cached_embeddings = await self.cache.get_batch(texts, self.model)
@@ -175,7 +270,7 @@ class EmbedderService:
         # 3. 如果全部命中，直接返回
         if not uncached_texts:
             logger.debug(f"✅ 缓存命中: {len(texts)}/{len(texts)}")
-            return cached_embeddings
+            return np.stack(cached_embeddings)
         
         # 4. 调用 API 获取未命中的向量
         logger.debug(f"📊 缓存命中: {len(texts) - len(uncached_texts)}/{len(texts)}, 需要请求: {len(uncached_texts)}")
@@ -185,13 +280,15 @@ class EmbedderService:
         await self.cache.set_batch(uncached_texts, self.model, new_embeddings)
         
         # 6. 合并结果
-        result = cached_embeddings[:]
-        for i, idx in enumerate(uncached_indices):
-            result[idx] = new_embeddings[i]
+        result = np.empty((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+        result[uncached_indices] = new_embeddings
+        for idx, embedding in enumerate(cached_embeddings):
+            if embedding is not None:
+                result[idx] = embedding
         
         return result
     
-    async def embed_query(self, query: str) -> List[float]:
+    async def embed_query(self, query: str) -> np.ndarray:
         """
         向量化单个查询
         
@@ -201,11 +298,60 @@ class EmbedderService:
         Returns:
             查询向量
         """
-        embeddings = await self.embed_texts([query], show_progress=False)
-        return embeddings[0]
+        if self.query_batch_size <= 1:
+            embeddings = await self.embed_texts([query], show_progress=False)
+            return embeddings[0]
+        
+        await self._ensure_cache()
+        if self._batcher_task is None or self._batcher_task.done():
+            self._batcher_task = asyncio.create_task(self._query_batcher())
+        
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        self._query_pending.set()
+        if len(self._pending) >= self.query_batch_size:
+            self._query_full.set()
+        
+        return await future
+    
+    async def _query_batcher(self):
+        """后台合批循环：攒满 query_batch_size 条或等待 query_flush_interval 后发送一次请求"""
+        while True:
+            await self._query_pending.wait()
+            
+            if len(self._pending) < self.query_batch_size:
+                try:
+                    await asyncio.wait_for(self._query_full.wait(), self.query_flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            
+            batch = self._pending[:self.query_batch_size]
+            del self._pending[:self.query_batch_size]
+            if len(self._pending) < self.query_batch_size:
+                self._query_full.clear()
+            if not self._pending:
+                self._query_pending.clear()
+            
+            try:
+                embeddings = await self._embed_batch_with_cache([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), embedding in zip(batch, embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
     
     async def close(self):
         """关闭 HTTP 客户端和缓存"""
+        if self._batcher_task is not None:
+            self._batcher_task.cancel()
+            for _, future in self._pending:
+                if not future.done():
+                    future.cancel()
+            self._pending.clear()
+        
         await self.client.aclose()
         if self._cache_initialized:
             await self.cache.close()
@@ -2,12 +2,24 @@
 索引服务
 负责扫描文档、构建索引
 """
+import asyncio
+import fnmatch
 import hashlib
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple
 
-from tqdm import tqdm
+from tqdm.asyncio import tqdm as async_tqdm
+
+try:
+    from blake3 import blake3 as _hasher
+except ImportError:
+    # 未安装 blake3 时退回标准库 blake2b
+    _hasher = hashlib.blake2b
 
 from config import settings, logger
 from models import Document, DocumentChunk
@@ -16,12 +28,29 @@ from database import MetadataStore, VectorStore
 from services.embedder import EmbedderService
 
 
+def _chunk_text(content: str, chunk_size: int, overlap: int,
+                min_chunk_size: int) -> List[Tuple[str, int, int]]:
+    """分块（模块级函数，可被子进程 pickle 调用；只传入文本、返回元组，降低序列化开销）"""
+    return MarkdownParser.chunk_content(
+        content, chunk_size=chunk_size, overlap=overlap, min_chunk_size=min_chunk_size
+    )
+
+
 class IndexerService:
     """索引构建服务"""
     
+    # 解析/分块在线程池中并行执行的最大并发数
+    PARSE_CONCURRENCY = 16
+    # 文档数达到该值时解析与分块改用多进程（纯 CPU 计算，线程受 GIL 限制只能用满单核）
+    PROCESS_POOL_MIN_DOCS = 500
+    
     def __init__(self):
         self.notes_dir = Path(settings.notes.directory)
         self.exclude_patterns = settings.notes.exclude_patterns
+        # 排除模式预编译为单个正则，按文件/目录名匹配
+        self._exclude_re = re.compile(
+            '|'.join(fnmatch.translate(p) for p in self.exclude_patterns) or r'(?!)'
+        )
         self.chunk_size = settings.indexing.chunk_size
         self.chunk_overlap = settings.indexing.chunk_overlap
         
@@ -60,57 +89,82 @@ class IndexerService:
             logger.warning("未找到任何 Markdown 文件")
             return
         
-        # 2. 解析文档
+        # 2. 解析文档（大语料用进程池批量解析，直接由解析结果构建文档；否则线程池并行）
+        if len(md_files) >= self.PROCESS_POOL_MIN_DOCS and (os.cpu_count() or 1) > 1:
+            parsed = await asyncio.to_thread(self._parse_documents_in_processes, md_files)
+        else:
+            parsed = await self._run_in_threads(self._parse_document_sync, md_files, "解析文档")
         documents = []
-        for file_path in tqdm(md_files, desc="解析文档"):
-            try:
-                doc = await self._parse_document(file_path)
-                if doc:
-                    documents.append(doc)
-            except Exception as e:
-                logger.error(f"解析文件失败 {file_path}: {str(e)}")
+        for file_path, doc in zip(md_files, parsed):
+            if isinstance(doc, Exception):
+                logger.error(f"解析文件失败 {file_path}: {str(doc)}")
+            elif doc:
+                documents.append(doc)
         
         logger.info(f"✅ 成功解析 {len(documents)} 个文档")
         
-        # 3. 分块处理
+        # 3. 分块处理（大语料用进程池，否则线程池）
         all_chunks = []
-        for doc in tqdm(documents, desc="分块处理"):
-            chunks = self._chunk_document(doc)
-            all_chunks.extend(chunks)
+        if len(documents) >= self.PROCESS_POOL_MIN_DOCS:
+            chunked = await self._chunk_in_processes(documents)
+        else:
+            chunked = await self._run_in_threads(self._chunk_document, documents, "分块处理")
+        for doc, chunks in zip(documents, chunked):
+            if isinstance(chunks, Exception):
+                logger.error(f"分块失败 {doc.file_path}: {str(chunks)}")
+            else:
+                all_chunks.extend(chunks)
         
         logger.info(f"✅ 生成 {len(all_chunks)} 个文档块")
         
-        # 4. 向量化
+        # 新索引建在独立的 VectorStore 中，数据库提交后才替换，构建期间检索仍使用旧索引
+        vector_store = VectorStore()
+        vector_store.create_index(expected_size=len(all_chunks))
+        
+        # 4. 分窗口流水线：向量化 → 写入向量索引，峰值内存与窗口大小相关而非语料规模
         logger.info(f"🔄 开始向量化 {len(all_chunks)} 个文档块...")
-        texts = [chunk.content for chunk in all_chunks]
+        window_size = self._pipeline_window_size()
         
+        # 索引构建期间缓存写入暂存于内存库，结束时一次性合并
+        await self.embedder.begin_bulk()
         try:
-            embeddings = await self.embedder.embed_texts(texts, show_progress=True)
+            # 量化参数用全语料随机样本训练（样本向量写入缓存，之后所在窗口直接命中，不重复请求）
+            if vector_store.needs_training and all_chunks:
+                sample = random.sample(all_chunks, min(len(all_chunks), VectorStore.SQ_TRAIN_SAMPLE))
+                vector_store.train(await self.embedder.embed_texts_np(
+                    [chunk.content for chunk in sample], show_progress=True
+                ))
             
-            # 将向量赋值给 chunk
-            for chunk, embedding in zip(all_chunks, embeddings):
-                chunk.embedding = embedding
+            for start in range(0, len(all_chunks), window_size):
+                window = all_chunks[start:start + window_size]
+                vectors = await self.embedder.embed_texts_np(
+                    [chunk.content for chunk in window], show_progress=True
+                )
+                
+                vector_store.add_vectors(window, vectors)
             
             logger.info(f"✅ 向量化完成")
         except Exception as e:
             logger.error(f"❌ 向量化失败: {str(e)}")
             raise
+        finally:
+            await self.embedder.commit_bulk()
         
-        # 5. 存储到数据库
-        self.vector_store.create_index()
-        
-        for doc in tqdm(documents, desc="存储元数据"):
-            await self._store_document(doc)
+        # 5. 存储文档元数据与分块（单个事务）：向量化全部成功后才写入，
+        # 失败时数据库、内存与磁盘上的旧索引保持一致
+        await self._bulk_store(documents, all_chunks)
         
-        for chunk in tqdm(all_chunks, desc="存储分块"):
-            await self._store_chunk(chunk)
-        
-        # 6. 构建向量索引
-        self.vector_store.add_vectors(all_chunks)
+        # 6. 替换为新索引并保存
+        self.vector_store = vector_store
         self.vector_store.save()
         
         logger.info(f"✅ 索引构建完成！")
     
+    def _pipeline_window_size(self) -> int:
+        """流水线窗口大小：一个窗口恰好占满所有并发的向量化请求"""
+        max_concurrent = getattr(settings.embedding, 'max_concurrent', 6)
+        return settings.embedding.batch_size * max_concurrent
+    
     async def load_index(self):
         """加载现有索引"""
         await self._ensure_initialized()
@@ -122,38 +176,94 @@ class IndexerService:
             logger.error("❌ 索引加载失败")
     
     def _scan_markdown_files(self) -> List[Path]:
-        """扫描 Markdown 文件"""
+        """扫描 Markdown 文件（单次遍历，原地剪除被排除的目录）"""
         md_files = []
+        exclude = self._exclude_re.match
         
-        for pattern in ['**/*.md', '**/*.markdown']:
-            for file_path in self.notes_dir.glob(pattern):
-                # 检查排除模式
-                should_exclude = False
-                for exclude in self.exclude_patterns:
-                    if exclude.startswith('*.'):
-                        # 文件扩展名匹配
-                        if file_path.suffix == exclude[1:]:
-                            should_exclude = True
-                            break
-                    elif file_path.match(exclude):
-                        should_exclude = True
-                        break
-                
-                if not should_exclude:
-                    md_files.append(file_path)
+        for root, dirs, files in os.walk(self.notes_dir):
+            dirs[:] = [d for d in dirs if not exclude(d)]
+            root_path = Path(root)
+            for name in files:
+                if name.endswith(('.md', '.markdown')) and not exclude(name):
+                    md_files.append(root_path / name)
         
         return md_files
     
+    async def _run_in_threads(self, func: Callable, items: List, desc: str) -> List:
+        """
+        在线程池中并行执行同步函数（并发数受 PARSE_CONCURRENCY 限制）
+        
+        Returns:
+            与 items 一一对应的结果列表，失败项为异常对象
+        """
+        semaphore = asyncio.Semaphore(self.PARSE_CONCURRENCY)
+        
+        async def run(item):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(func, item)
+                except Exception as e:
+                    return e
+        
+        return await async_tqdm.gather(*[run(item) for item in items], desc=desc)
+    
+    async def _chunk_in_processes(self, documents: List[Document]) -> List:
+        """
+        在进程池中并行分块，子进程只返回 (text, start, end) 元组，DocumentChunk 在主进程构建
+        
+        Returns:
+            与 documents 一一对应的结果列表，失败项为异常对象
+        """
+        loop = asyncio.get_running_loop()
+        min_chunk_size = settings.indexing.min_chunk_size
+        
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            async def run(doc: Document):
+                try:
+                    # 小文档整体作为一个分块（chunk_content 直接返回），在主进程处理，省去进程间往返
+                    if len(doc.content) < self.chunk_size:
+                        return self._chunk_document(doc)
+                    chunks_data = await loop.run_in_executor(
+                        pool, _chunk_text, doc.content,
+                        self.chunk_size, self.chunk_overlap, min_chunk_size
+                    )
+                    return self._build_chunks(doc, chunks_data)
+                except Exception as e:
+                    return e
+            
+            return await async_tqdm.gather(*[run(doc) for doc in documents], desc="分块处理（多进程）")
+    
     async def _parse_document(self, file_path: Path) -> Document:
+        """解析单个文档（在线程池中执行）"""
+        return await asyncio.to_thread(self._parse_document_sync, file_path)
+    
+    def _parse_documents_in_processes(self, md_files: List[Path]) -> List:
+        """
+        进程池批量解析并构建文档（解析结果直接使用，不经解析缓存再读一遍，语料大于缓存容量时也只解析一次）
+        
+        Returns:
+            与 md_files 一一对应的文档列表，失败项为异常对象
+        """
+        results = []
+        for file_path, parsed in zip(md_files, self.parser.parse_files(md_files)):
+            if isinstance(parsed, Exception):
+                results.append(parsed)
+                continue
+            try:
+                results.append(self._build_document(file_path, *parsed))
+            except Exception as e:
+                results.append(e)
+        return results
+    
+    def _parse_document_sync(self, file_path: Path) -> Document:
         """解析单个文档"""
         content, metadata = self.parser.parse_file(file_path)
-        
-        # 提取双链和标签
-        backlinks = self.parser.extract_backlinks(content)
-        tags = self.parser.extract_tags(content)
-        
-        # 清理内容
-        clean_content = self.parser.clean_content(content)
+        return self._build_document(file_path, content, metadata)
+    
+    def _build_document(self, file_path: Path, content: str, metadata: Dict) -> Document:
+        """由解析出的正文与元数据构建文档"""
+        # 提取标签、双链并清理内容（标签与双链单次遍历提取）
+        tags, backlinks, clean_content = self.parser.scan(content)
         
         return Document(
             file_path=file_path,
@@ -163,19 +273,21 @@ class IndexerService:
             modified_at=metadata.get('modified_at'),
             tags=tags,
             backlinks=backlinks,
-            metadata=metadata
+            metadata=metadata,
+            doc_id=self._generate_doc_id(file_path)
         )
     
     def _chunk_document(self, doc: Document) -> List[DocumentChunk]:
         """分块文档"""
-        chunks_data = self.parser.chunk_content(
-            doc.content,
-            chunk_size=self.chunk_size,
-            overlap=self.chunk_overlap,
-            min_chunk_size=settings.indexing.min_chunk_size
+        chunks_data = _chunk_text(
+            doc.content, self.chunk_size, self.chunk_overlap, settings.indexing.min_chunk_size
         )
-        
-        doc_id = self._generate_doc_id(doc.file_path)
+        return self._build_chunks(doc, chunks_data)
+    
+    def _build_chunks(self, doc: Document,
+                      chunks_data: List[Tuple[str, int, int]]) -> List[DocumentChunk]:
+        """由分块元组构建 DocumentChunk（继承父文档元数据）"""
+        doc_id = self._doc_id(doc)
         
         chunks = []
         for idx, (chunk_text, start_pos, end_pos) in enumerate(chunks_data):
@@ -200,49 +312,47 @@ class IndexerService:
         
         return chunks
     
-    async def _store_document(self, doc: Document):
-        """存储文档元数据"""
-        doc_id = self._generate_doc_id(doc.file_path)
-        content_hash = self._hash_content(doc.content)
-        
-        await self.metadata_store.insert_document(
-            doc_id=doc_id,
-            file_path=str(doc.file_path),
-            title=doc.title,
-            created_at=doc.created_at,
-            modified_at=doc.modified_at,
-            content_hash=content_hash,
-            metadata=doc.metadata
-        )
-        
-        # 存储标签
-        if doc.tags:
-            await self.metadata_store.insert_tags(doc_id, doc.tags)
-        
-        # 存储双链
-        if doc.backlinks:
-            await self.metadata_store.insert_backlinks(doc_id, doc.backlinks)
+    async def _bulk_store(self, documents: List[Document], chunks: List[DocumentChunk]):
+        """批量存储文档、标签、双链和分块（单事务）"""
+        doc_rows, tag_rows, backlink_rows = [], [], []
+        for doc in documents:
+            doc_id = self._doc_id(doc)
+            doc_rows.append((
+                doc_id, str(doc.file_path), doc.title, doc.created_at, doc.modified_at,
+                self._hash_content(doc.content),
+                self.metadata_store.serialize_metadata(doc.metadata)
+            ))
+            tag_rows.extend((doc_id, tag) for tag in doc.tags)
+            backlink_rows.extend((doc_id, target) for target in doc.backlinks)
+        
+        chunk_rows = [
+            (chunk.chunk_id, chunk.document_id, chunk.content,
+             chunk.chunk_index, chunk.start_pos, chunk.end_pos)
+            for chunk in chunks
+        ]
+        
+        await self.metadata_store.bulk_store(doc_rows, tag_rows, backlink_rows, chunk_rows)
     
-    async def _store_chunk(self, chunk: DocumentChunk):
-        """存储分块"""
-        await self.metadata_store.insert_chunk(
-            chunk_id=chunk.chunk_id,
-            doc_id=chunk.document_id,
-            content=chunk.content,
-            chunk_index=chunk.chunk_index,
-            start_pos=chunk.start_pos,
-            end_pos=chunk.end_pos
-        )
+    def _doc_id(self, doc: Document) -> str:
+        """文档ID（首次计算后记录在 Document 上）"""
+        if doc.doc_id is None:
+            doc.doc_id = self._generate_doc_id(doc.file_path)
+        return doc.doc_id
     
     def _generate_doc_id(self, file_path: Path) -> str:
         """生成文档ID"""
         # 使用相对路径的 hash
         rel_path = file_path.relative_to(self.notes_dir)
-        return hashlib.md5(str(rel_path).encode()).hexdigest()
+        return self._digest(str(rel_path))
     
     def _hash_content(self, content: str) -> str:
         """计算内容哈希"""
-        return hashlib.md5(content.encode()).hexdigest()
+        return self._digest(content)
+    
+    @staticmethod
+    def _digest(text: str) -> str:
+        """128 位十六进制摘要（BLAKE3，内部去重键，无需密码学强度）"""
+        return _hasher(text.encode('utf-8')).digest()[:16].hex()
     
     async def get_stats(self) -> Dict:
         """获取索引统计信息"""
@@ -2,23 +2,50 @@
 LLM 服务
 调用 AI Builders Chat Completions API
 """
-from typing import List, Dict
-import json
+from typing import AsyncIterator, List, Dict
 
 import httpx
+import orjson
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
 
 from config import settings, logger
 
 
+# 提示词模板（模块级常量，避免每次请求重复构建）
+_LOCAL_HEADER = "\n## 本地笔记相关内容：\n"
+_WEB_HEADER = "\n## 网络资源相关内容：\n"
+_PROMPT_ITEM = "\n{}. 【{}】{}...\n"
+# 静态部分（系统提示 + 回答要求）固定放在消息最前，逐字节不变，便于服务端前缀缓存命中
+_SYSTEM_MSG = "你是一个智能笔记助手，负责根据用户的笔记内容和网络资源回答用户的问题。请基于提供的检索结果生成准确、有用的答案。"
+_GUIDE = """## 回答要求：
+1. 请基于用户消息中的检索结果回答用户的问题
+2. 如果本地笔记有相关内容，优先使用本地笔记
+3. 如果需要补充信息，可以参考网络资源
+4. 回答要清晰、准确、有条理
+5. 如果检索结果无法回答问题，请坦诚说明
+"""
+# 降级答案中的单条结果（标题行 + 内容预览行）
+_FALLBACK_ITEM = "\n{}. {}\n   {}..."
+
+
 class LLMService:
     """LLM 服务"""
     
+    # 请求失败时最多读取的响应体字节数（仅用于日志）
+    ERROR_BODY_LIMIT = 4096
+    
     def __init__(self):
         self.api_base = settings.llm.api_base
         self.model = settings.llm.model
         self.api_key = settings.api_key
         self.temperature = settings.llm.temperature
         self.max_tokens = settings.llm.max_tokens
+        self._prefix_messages = self._static_messages(self.model)
         
         # 创建 HTTP 客户端
         self.client = httpx.AsyncClient(
@@ -32,17 +59,28 @@ class LLMService:
                 read=120.0,
                 write=60.0,
                 pool=10.0
+            ),
+            # 显式传入 transport 时，连接池与 HTTP/2 参数需设置在 transport 上
+            # HTTP/2 在同一 TLS 连接上复用并发的对话请求；retries 仅重试建连失败
+            transport=httpx.AsyncHTTPTransport(
+                http2=HTTP2_ENABLED,
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60.0
+                ),
+                retries=1
             )
         )
     
-    async def generate_answer_stream(
+    async def stream_answer(
         self, 
         query: str, 
         local_results: List[Dict], 
         web_results: List[Dict]
-    ):
+    ) -> AsyncIterator[str]:
         """
-        流式生成答案 - 使用 SSE 流式返回
+        流式生成答案（出错时直接抛出异常，由调用方决定降级方式）
         
         Args:
             query: 用户问题
@@ -52,79 +90,83 @@ class LLMService:
         Yields:
             str: 流式生成的文本片段
         """
-        try:
-            # 构建提示词
-            prompt = self._build_prompt(query, local_results, web_results)
+        # 构建提示词
+        prompt = self._build_prompt(query, local_results, web_results)
+        
+        logger.info(f"🤖 LLM 流式生成开始 (model={self.model})")
+        
+        # 调用 Chat Completions API（流式）
+        async with self.client.stream(
+            "POST",
+            "/v1/chat/completions",
+            json={
+                "model": self.model,
+                "messages": self._build_messages(prompt),
+                "temperature": self.temperature,
+                "max_tokens": self.max_tokens,
+                "stream": True  # 启用流式响应
+            }
+        ) as response:
+            # 检查状态码（如果失败，读取部分响应体用于日志并抛出异常）
+            if response.status_code >= 400:
+                error_body = await self._read_head(response, self.ERROR_BODY_LIMIT)
+                logger.error(f"❌ LLM API 请求失败: {response.status_code}")
+                logger.error(f"❌ 响应体: {error_body[:200].decode('utf-8', errors='replace')}")
+                raise httpx.HTTPStatusError(
+                    f"HTTP {response.status_code}",
+                    request=response.request,
+                    response=response
+                )
             
-            logger.info(f"🤖 LLM 流式生成开始 (model={self.model})")
+            logger.info(f"✅ LLM API 连接成功，开始接收流式数据")
             
-            # 调用 Chat Completions API（流式）
-            async with self.client.stream(
-                "POST",
-                "/v1/chat/completions",
-                json={
-                    "model": self.model,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "你是一个智能笔记助手，负责根据用户的笔记内容和网络资源回答用户的问题。请基于提供的检索结果生成准确、有用的答案。"
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "temperature": self.temperature,
-                    "max_tokens": self.max_tokens,
-                    "stream": True  # 启用流式响应
-                }
-            ) as response:
-                # 检查状态码（如果失败，手动读取响应体并抛出异常）
-                if response.status_code >= 400:
-                    error_body = await response.aread()
-                    logger.error(f"❌ LLM API 请求失败: {response.status_code}")
-                    logger.error(f"❌ 响应体: {error_body.decode('utf-8')}")
-                    raise httpx.HTTPStatusError(
-                        f"HTTP {response.status_code}",
-                        request=response.request,
-                        response=response
-                    )
-                
-                logger.info(f"✅ LLM API 连接成功，开始接收流式数据")
+            # 逐个读取 SSE 事件（按字节切分，orjson 直接解析 bytes，无需先解码为 str）
+            async for payload in self._iter_sse_events(response):
+                # 检查结束标记
+                if payload == b"[DONE]":
+                    logger.info(f"✅ LLM 流式生成完成")
+                    break
                 
-                # 逐行读取 SSE 流
-                async for line in response.aiter_lines():
-                    if not line or line.startswith(":"):
-                        continue
+                try:
+                    # 解析 JSON
+                    chunk = orjson.loads(payload)
                     
-                    # 移除 "data: " 前缀
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    
-                    # 检查结束标记
-                    if line == "[DONE]":
-                        logger.info(f"✅ LLM 流式生成完成")
-                        break
-                    
-                    try:
-                        # 解析 JSON
-                        chunk = json.loads(line)
+                    # 提取内容
+                    if "choices" in chunk and len(chunk["choices"]) > 0:
+                        delta = chunk["choices"][0].get("delta", {})
+                        content = delta.get("content", "")
                         
-                        # 提取内容
-                        if "choices" in chunk and len(chunk["choices"]) > 0:
-                            delta = chunk["choices"][0].get("delta", {})
-                            content = delta.get("content", "")
-                            
-                            if content:
-                                yield content
-                    
-                    except json.JSONDecodeError:
-                        logger.warning(f"⚠️ 无法解析 SSE 数据: {line}")
-                        continue
+                        # 逐个 delta 直接输出，合并写出由接口层的 batch_sse_frames 按时限完成
+                        if content:
+                            yield content
+                
+                except orjson.JSONDecodeError:
+                    logger.warning(f"⚠️ 无法解析 SSE 数据: {payload[:200].decode('utf-8', errors='replace')}")
+                    continue
+    
+    async def generate_answer_stream(
+        self, 
+        query: str, 
+        local_results: List[Dict], 
+        web_results: List[Dict]
+    ):
+        """
+        流式生成答案 - 使用 SSE 流式返回（失败时返回降级答案）
+        
+        Args:
+            query: 用户问题
+            local_results: 本地检索结果
+            web_results: 网络检索结果
+        
+        Yields:
+            str: 流式生成的文本片段
+        """
+        try:
+            async for content in self.stream_answer(query, local_results, web_results):
+                yield content
         
         except httpx.HTTPStatusError as e:
-            # 这个异常已经在上面处理过了（手动读取响应体）
-            # 这里只会捕获其他 HTTP 错误
+            # 响应体已在 stream_answer 中读取并记录
             logger.error(f"❌ LLM API 请求失败: {e}")
             # 降级方案：返回完整答案
             yield self._fallback_answer(query, local_results, web_results)
@@ -136,6 +178,59 @@ class LLMService:
             # 降级方案：返回完整答案
             yield self._fallback_answer(query, local_results, web_results)
     
+    @staticmethod
+    async def _read_head(response: httpx.Response, limit: int) -> bytes:
+        """读取流式响应体的前 limit 字节（不缓冲完整响应体）"""
+        buffer = bytearray()
+        async for data in response.aiter_bytes():
+            buffer += data
+            if len(buffer) >= limit:
+                break
+        return bytes(buffer[:limit])
+    
+    @classmethod
+    async def _iter_sse_events(cls, response: httpx.Response) -> AsyncIterator[bytes]:
+        """
+        按 SSE 规范组装事件，逐个返回 data 字段内容
+        
+        - "data:" 后的空格可省略；同一事件的多行 data 以 \n 拼接（JSON 被拆成多行时也能完整解析）
+        - 空行表示事件结束；注释行（":" 开头）及 event/id/retry 字段忽略
+        - 兼容不带 "data:" 前缀、直接逐行输出 JSON 的服务
+        """
+        data_lines: List[bytes] = []
+        async for line in cls._iter_sse_lines(response):
+            if not line:
+                if data_lines:
+                    yield b"\n".join(data_lines)
+                    data_lines = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                data_lines.append(value[1:] if value.startswith(b" ") else value)
+            elif line.startswith((b"{", b"[")):
+                yield line
+        if data_lines:
+            yield b"\n".join(data_lines)
+    
+    @staticmethod
+    async def _iter_sse_lines(response: httpx.Response) -> AsyncIterator[bytes]:
+        """
+        按 \n 切分响应字节流，逐行返回 bytes（去除行尾 \r）
+        
+        使用可变 bytearray 缓冲区原地消费已处理的行，跨多个网络块的长行不会反复拼接复制；
+        aiter_bytes 不指定 chunk_size，收到数据即处理，避免为凑满块而延迟首字
+        """
+        buffer = bytearray()
+        async for data in response.aiter_bytes():
+            buffer += data
+            start = 0
+            while (newline := buffer.find(b"\n", start)) >= 0:
+                end = newline - 1 if newline > start and buffer[newline - 1] == 0x0D else newline
+                yield bytes(buffer[start:end])
+                start = newline + 1
+            del buffer[:start]
+        if buffer:
+            yield bytes(buffer.rstrip(b"\r"))
+    
     async def generate_answer(
         self, 
         query: str, 
@@ -165,16 +260,7 @@ class LLMService:
                 "/v1/chat/completions",
                 json={
                     "model": self.model,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "你是一个智能笔记助手，负责根据用户的笔记内容和网络资源回答用户的问题。请基于提供的检索结果生成准确、有用的答案。"
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
+                    "messages": self._build_messages(prompt),
                     "temperature": self.temperature,
                     "max_tokens": self.max_tokens
                 }
@@ -231,38 +317,54 @@ class LLMService:
         Returns:
             提示词字符串
         """
+        # 每条结果由一个模板一次格式化完成，最后单次 join
         prompt_parts = [f"用户问题：{query}\n"]
         
-        # 添加本地笔记内容
+        # 添加本地笔记内容（限制内容长度 500）
         if local_results:
-            prompt_parts.append("\n## 本地笔记相关内容：\n")
-            for idx, result in enumerate(local_results[:5], 1):
-                title = result.get("title", "未知标题")
-                content = result.get("content", "")[:500]  # 限制内容长度
-                prompt_parts.append(f"\n{idx}. 【{title}】")
-                prompt_parts.append(f"{content}...\n")
+            prompt_parts.append(_LOCAL_HEADER)
+            prompt_parts.extend(
+                _PROMPT_ITEM.format(idx, r.get("title", "未知标题"), r.get("content", "")[:500])
+                for idx, r in enumerate(local_results[:5], 1)
+            )
         
-        # 添加网络资源内容
+        # 添加网络资源内容（限制内容长度 400）
         if web_results:
-            prompt_parts.append("\n## 网络资源相关内容：\n")
-            for idx, result in enumerate(web_results[:3], 1):
-                title = result.get("title", "未知标题")
-                content = result.get("content", "")[:400]  # 限制内容长度
-                prompt_parts.append(f"\n{idx}. 【{title}】")
-                prompt_parts.append(f"{content}...\n")
-        
-        # 添加指导
-        prompt_parts.append("""
-\n## 回答要求：
-1. 请基于上述检索结果回答用户的问题
-2. 如果本地笔记有相关内容，优先使用本地笔记
-3. 如果需要补充信息，可以参考网络资源
-4. 回答要清晰、准确、有条理
-5. 如果检索结果无法回答问题，请坦诚说明
-""")
+            prompt_parts.append(_WEB_HEADER)
+            prompt_parts.extend(
+                _PROMPT_ITEM.format(idx, r.get("title", "未知标题"), r.get("content", "")[:400])
+                for idx, r in enumerate(web_results[:3], 1)
+            )
         
         return ''.join(prompt_parts)
     
+    def _build_messages(self, prompt: str) -> List[Dict]:
+        """组装消息：静态前缀（复用同一列表）+ 动态用户消息"""
+        return [*self._prefix_messages, {"role": "user", "content": prompt}]
+    
+    @staticmethod
+    def _static_messages(model: str) -> List[Dict]:
+        """
+        静态系统消息
+        
+        Claude 系列模型需显式标记 cache_control 才会缓存前缀；
+        其他模型（如 OpenAI 自动前缀缓存）只要前缀完全一致即可命中
+        """
+        if 'claude' not in model.lower():
+            return [
+                {"role": "system", "content": _SYSTEM_MSG},
+                {"role": "system", "content": _GUIDE}
+            ]
+        return [
+            {
+                "role": "system",
+                "content": [
+                    {"type": "text", "text": _SYSTEM_MSG},
+                    {"type": "text", "text": _GUIDE, "cache_control": {"type": "ephemeral"}}
+                ]
+            }
+        ]
+    
     def _fallback_answer(
         self, 
         query: str, 
@@ -286,19 +388,17 @@ class LLMService:
         
         if local_results:
             answer_parts.append("\n📚 本地笔记：")
-            for idx, result in enumerate(local_results[:5], 1):
-                title = result.get("title", "未知标题")
-                content = result.get("content", "")[:100]
-                answer_parts.append(f"\n{idx}. {title}")
-                answer_parts.append(f"   {content}...")
+            answer_parts.extend(
+                _FALLBACK_ITEM.format(idx, r.get("title", "未知标题"), r.get("content", "")[:100])
+                for idx, r in enumerate(local_results[:5], 1)
+            )
         
         if web_results:
             answer_parts.append("\n\n🌐 网络资源：")
-            for idx, result in enumerate(web_results[:3], 1):
-                title = result.get("title", "未知标题")
-                content = result.get("content", "")[:100]
-                answer_parts.append(f"\n{idx}. {title}")
-                answer_parts.append(f"   {content}...")
+            answer_parts.extend(
+                _FALLBACK_ITEM.format(idx, r.get("title", "未知标题"), r.get("content", "")[:100])
+                for idx, r in enumerate(web_results[:3], 1)
+            )
         
         return '\n'.join(answer_parts)
     
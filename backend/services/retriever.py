@@ -3,30 +3,159 @@
 混合检索：本地向量检索 + 网络搜索
 """
 from datetime import datetime, timedelta
-from typing import List, Dict
+from functools import lru_cache
+from operator import attrgetter
+import hashlib
+from typing import List, Dict, Optional, Tuple
 import asyncio
+import re
+
+import numpy as np
+from cachetools import TTLCache
+from dateutil import parser as date_parser
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None  # 未安装 pyahocorasick 时逐个关键词做子串匹配
 
 from config import settings, logger
 from models import SearchResult
-from services.embedder import EmbedderService
 from services.web_search import WebSearchService
 from services.llm import LLMService
 
 
+# 标题加权：查询分词规则与停用词
+_QUERY_SPLIT_RE = re.compile(r'[\s，。！？、]+')
+_TITLE_STOPWORDS = frozenset({
+    '的', '了', '和', '是', '在', '有', '我', '你', '他', '她', '它',
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
+    '告诉', '笔记', '中', '哪些', '相关', '信息', '关于', '有关', '么', '吗'
+})
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    """解析数据库中的时间（自身写入的是 ISO 8601，走 C 实现的 fromisoformat；其他格式退回 dateutil）"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return date_parser.parse(value)
+
+
+def _query_keywords(query: str) -> frozenset:
+    """
+    提取查询关键词（英文按单词，中文取 2 字词和 3 字词）
+    
+    Returns:
+        去除停用词后的关键词集合
+    """
+    keywords = set()
+    
+    # 按空格/标点分割（处理英文单词）
+    for token in _QUERY_SPLIT_RE.split(query.lower()):
+        token = token.strip()
+        if not token:
+            continue
+        
+        # 如果是英文单词（长度>=2）
+        if token.isascii():
+            if len(token) >= 2 and token not in _TITLE_STOPWORDS:
+                keywords.add(token)
+            continue
+        
+        # 如果包含中文，提取2字词和3字词
+        for size in (2, 3):
+            for i in range(len(token) - size + 1):
+                word = token[i:i + size]
+                if word not in _TITLE_STOPWORDS and not word.isascii():
+                    keywords.add(word)
+    
+    return frozenset(keywords)
+
+
+@lru_cache(maxsize=1024)
+def _query_matcher(query: str) -> Tuple[frozenset, Optional[object]]:
+    """
+    按查询缓存关键词集合及其 Aho-Corasick 自动机
+    
+    Returns:
+        (关键词集合, 自动机)；未安装 pyahocorasick 或无关键词时自动机为 None
+    """
+    keywords = _query_keywords(query)
+    if ahocorasick is None or not keywords:
+        return keywords, None
+    
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return keywords, automaton
+
+
 class RetrieverService:
     """检索服务"""
     
-    def __init__(self, indexer):
+    # 答案缓存：相同查询 + 相同检索结果（含正文）直接复用上次生成的答案
+    ANSWER_CACHE_SIZE = 512
+    # 不超过网页正文缓存的有效期，网页内容更新后答案随之过期
+    ANSWER_CACHE_TTL = WebSearchService.PAGE_CACHE_TTL
+    ANSWER_CACHE_MAX_CHARS = 20000  # 过长的答案不缓存
+    # 查询向量缓存：重复查询跳过向量化（1024 × 1536 维 float32 约 6MB）
+    QUERY_VECTOR_CACHE_SIZE = 1024
+    QUERY_VECTOR_CACHE_TTL = 600
+    
+    def __init__(self, indexer, llm: Optional[LLMService] = None):
+        """
+        Args:
+            indexer: 索引服务（复用其向量化服务，共享 HTTP 连接池与向量缓存）
+            llm: 共享的 LLM 服务；未传入时自行创建，并由 close() 负责关闭
+        """
         self.indexer = indexer
-        self.embedder = EmbedderService()
+        self.embedder = indexer.embedder
         self.web_search = WebSearchService()
-        self.llm = LLMService()
+        self._owns_llm = llm is None
+        self.llm = llm or LLMService()
         
         # 检索配置
         self.time_decay_config = settings.search.time_decay
+        # 时间衰减阈值在初始化时计算一次
+        self._recent_window = timedelta(days=self.time_decay_config.recent_months * 30)
+        self._old_window = timedelta(days=self.time_decay_config.old_years * 365)
         self.similarity_threshold = settings.search.similarity_threshold
+        
+        self._answer_cache = TTLCache(maxsize=self.ANSWER_CACHE_SIZE, ttl=self.ANSWER_CACHE_TTL)
+        self._query_vector_cache = TTLCache(
+            maxsize=self.QUERY_VECTOR_CACHE_SIZE, ttl=self.QUERY_VECTOR_CACHE_TTL
+        )
+    
+    async def close(self):
+        """关闭网络搜索客户端及自行创建的 LLM 服务（向量化服务由索引服务关闭）"""
+        await self.web_search.close()
+        if self._owns_llm:
+            await self.llm.close()
     
-    async def hybrid_search(self, query: str, local_ratio: float = None) -> List[Dict]:
+    def clear_answer_cache(self):
+        """清空答案缓存（索引重建后调用，分块内容可能已变化）"""
+        self._answer_cache.clear()
+    
+    @staticmethod
+    def _answer_cache_key(query: str, results: List[SearchResult]) -> bytes:
+        """
+        答案缓存键：规范化查询 + 排序后的结果标识（分数保留 3 位小数）及标题、正文
+        
+        标题与正文即提示词的输入，网络结果的 URL 不变但页面内容变化时不会命中旧答案
+        """
+        normalized_query = ' '.join(query.lower().split())
+        result_keys = sorted(
+            f"{r.chunk_id or r.url or r.file_path}:{r.score:.3f}\x1e{r.title}\x1e{r.content}"
+            for r in results
+        )
+        key_str = '\x1f'.join([normalized_query, *result_keys])
+        return hashlib.blake2b(key_str.encode('utf-8'), digest_size=16).digest()
+    
+    async def hybrid_search(self, query: str, local_ratio: float = None) -> List[SearchResult]:
         """
         混合检索（本地 + 网络）
         
@@ -49,34 +178,29 @@ class RetrieverService:
         
         logger.info(f"🔍 混合检索: local_ratio={local_ratio:.2f}, local_k={local_k}, network_k={network_k}")
         
-        # 并发执行本地和网络检索（优化：local_k=0 时跳过本地检索）
-        tasks = []
+        # 并发执行本地和网络检索（top_k 为 0 的一方直接跳过，不创建占位任务）
+        tasks = {}
         if local_k > 0:
-            tasks.append(self.local_search(query, top_k=local_k))
+            tasks['local'] = self.local_search(query, top_k=local_k)
         else:
             logger.info("⏩ 跳过本地检索 (local_ratio=0)")
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))  # 占位任务
         
         if network_k > 0:
-            tasks.append(self.web_search_async(query, top_k=network_k))
+            tasks['web'] = self.web_search_async(query, top_k=network_k)
         else:
             logger.info("⏩ 跳过网络检索 (network_ratio=0)")
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))  # 占位任务
         
-        results = await asyncio.gather(*tasks)
-        
-        # 提取结果（处理占位任务）
-        local_results = results[0] if local_k > 0 and isinstance(results[0], list) else []
-        web_results = results[1] if network_k > 0 and len(results) > 1 and isinstance(results[1], list) else []
+        done = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        local_results = done.get('local', [])
+        web_results = done.get('web', [])
         
         # 合并结果
         all_results = local_results + web_results
         
-        # 按分数排序
+        # 按分数排序（由接口层用 orjson 直接序列化 dataclass，无需中间字典）
         all_results.sort(key=lambda x: x.score, reverse=True)
         
-        # 转换为字典
-        return [result.to_dict() for result in all_results]
+        return all_results
     
     async def local_search(self, query: str, top_k: int = 20) -> List[SearchResult]:
         """
@@ -96,8 +220,8 @@ class RetrieverService:
         
         logger.info(f"🔍 本地检索: query=\"{query}\", top_k={top_k}")
         
-        # 1. 向量化查询
-        query_vector = await self.embedder.embed_query(query)
+        # 1. 向量化查询（重复查询直接复用缓存的向量）
+        query_vector = await self._embed_query_cached(query)
         
         # 2. 向量检索（扩大搜索范围以便后续过滤）
         vector_results = self.indexer.vector_store.search(query_vector, top_k=top_k * 3)
@@ -108,47 +232,68 @@ class RetrieverService:
         
         logger.info(f"📊 向量检索返回 {len(vector_results)} 条候选结果")
         
-        # 3. 获取分块详细信息（带上下文扩展）
+        # 3. 先按相似度阈值过滤，只为通过的候选查询元数据
+        candidates = [
+            (chunk_id, similarity_score)
+            for chunk_id, similarity_score in vector_results
+            if similarity_score >= self.similarity_threshold
+        ]
+        
+        if not candidates:
+            logger.info(f"🔍 相似度过滤: {len(vector_results)} → 0 (阈值={self.similarity_threshold})，跳过上下文扩展")
+            return []
+        
+        # 4. 获取分块详细信息（带上下文扩展，所有候选一次批量查询）
+        chunk_data_map = await self._get_chunk_data_batch(
+            [chunk_id for chunk_id, _ in candidates],
+            context_before=settings.search.context_before,
+            context_after=settings.search.context_after
+        )
+        
+        # 5. 综合得分：向量相似度 * 时间权重 * 标题权重（按数组整体计算）
+        kept = [(chunk_id, chunk_data_map[chunk_id]) for chunk_id, _ in candidates if chunk_id in chunk_data_map]
+        logger.info(f"🔍 相似度过滤: {len(vector_results)} → {len(kept)} (阈值={self.similarity_threshold})")
+        if not kept:
+            return []
+        
+        now = datetime.now()
+        count = len(kept)
+        similarities = np.fromiter(
+            (score for chunk_id, score in candidates if chunk_id in chunk_data_map),
+            dtype=np.float64, count=count
+        )
+        time_weights = np.fromiter(
+            (self._calculate_time_decay(data['modified_at'], now) for _, data in kept),
+            dtype=np.float64, count=count
+        )
+        title_boosts = np.fromiter(
+            (self._calculate_title_boost(query, data.get('title', '')) for _, data in kept),
+            dtype=np.float64, count=count
+        )
+        scores = similarities * time_weights * title_boosts
+        
+        # 6. Top-K：argpartition 线性选出前 K 个，只对这 K 个排序（同分按原顺序）
+        if count > top_k:
+            selected = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            selected = np.arange(count)
+        selected = selected[np.lexsort((selected, -scores[selected]))]
+        
+        # 只为入选结果构建 SearchResult
         results = []
-        for chunk_id, similarity_score in vector_results:
-            # 从元数据库获取分块信息（带上下文）
-            chunk_data = await self._get_chunk_data_with_context(
-                chunk_id,
-                context_before=settings.search.context_before,
-                context_after=settings.search.context_after
-            )
-            
-            if chunk_data and similarity_score >= self.similarity_threshold:
-                # 应用时间衰减
-                time_weight = self._calculate_time_decay(chunk_data['modified_at'])
-                
-                # 🆕 标题匹配加权
-                title_boost = self._calculate_title_boost(query, chunk_data.get('title', ''))
-                
-                # 综合得分：向量相似度 * 时间权重 * 标题权重
-                final_score = similarity_score * time_weight * title_boost
-                
-                result = SearchResult(
-                    content=chunk_data['extended_content'],  # 使用扩展后的内容
-                    file_path=chunk_data['file_path'],
-                    title=chunk_data['title'],
-                    score=final_score,
-                    source="local",
-                    chunk_id=chunk_id,
-                    tags=chunk_data.get('tags', []),
-                    backlinks=chunk_data.get('backlinks', []),
-                    created_at=chunk_data.get('created_at')
-                )
-                
-                results.append(result)
-        
-        logger.info(f"🔍 相似度过滤: {len(vector_results)} → {len(results)} (阈值={self.similarity_threshold})")
-        
-        # 按分数排序
-        results.sort(key=lambda x: x.score, reverse=True)
-        
-        # 返回 top_k
-        results = results[:top_k]
+        for i in selected:
+            chunk_id, chunk_data = kept[i]
+            results.append(SearchResult(
+                content=chunk_data['extended_content'],  # 使用扩展后的内容
+                file_path=chunk_data['file_path'],
+                title=chunk_data['title'],
+                score=float(scores[i]),
+                source="local",
+                chunk_id=chunk_id,
+                tags=chunk_data.get('tags', []),
+                backlinks=chunk_data.get('backlinks', []),
+                created_at=chunk_data.get('created_at')
+            ))
         
         # 打印详细检索结果（方便调试）
         logger.info(f"✅ 本地检索完成，返回 {len(results)} 条结果")
@@ -163,6 +308,19 @@ class RetrieverService:
         return results
 
     
+    async def _embed_query_cached(self, query: str) -> np.ndarray:
+        """
+        带缓存的查询向量化
+        
+        缓存键只去除首尾空白，不做大小写折叠，避免改变实际送入模型的文本
+        """
+        key = query.strip()
+        vector = self._query_vector_cache.get(key)
+        if vector is None:
+            vector = await self.embedder.embed_query(key)
+            self._query_vector_cache[key] = vector
+        return vector
+    
     async def web_search_async(self, query: str, top_k: int = 5) -> List[SearchResult]:
         """
         网络搜索
@@ -197,65 +355,71 @@ class RetrieverService:
         logger.info(f"✅ 网络检索完成，返回 {len(results)} 条结果")
         return results
     
-    async def _get_chunk_data(self, chunk_id: str) -> Dict:
-        """获取分块数据"""
-        # 从元数据库查询
-        doc_id = chunk_id.rsplit('_chunk_', 1)[0]
-        
-        cursor = await self.indexer.metadata_store.conn.execute(
-            "SELECT * FROM chunks WHERE chunk_id = ?",
-            (chunk_id,)
-        )
-        chunk_row = await cursor.fetchone()
+    async def _get_chunk_data_batch(self, chunk_ids: List[str],
+                                    context_before: int = 3,
+                                    context_after: int = 2) -> Dict[str, Dict]:
+        """
+        批量获取分块数据并包含上下文（所有命中共用两次 IN 查询：分块内容、文档及其标签双链）
         
-        if not chunk_row:
-            return None
+        Args:
+            chunk_ids: chunk ID 列表
+            context_before: 包含前面 N 个 chunk
+            context_after: 包含后面 N 个 chunk
         
-        # 获取文档信息
-        cursor = await self.indexer.metadata_store.conn.execute(
-            "SELECT * FROM documents WHERE doc_id = ?",
-            (doc_id,)
+        Returns:
+            {chunk_id: chunk 数据（含 extended_content）}，分块或文档不存在的 ID 不出现在结果中
+        """
+        store = self.indexer.metadata_store
+        
+        # 解析 doc_id 和 chunk_index，生成上下文窗口内所有 chunk ID（含当前 chunk）
+        windows = {}
+        for chunk_id in chunk_ids:
+            doc_id, chunk_idx_str = chunk_id.rsplit('_chunk_', 1)
+            chunk_idx = int(chunk_idx_str)
+            windows[chunk_id] = (doc_id, [
+                f"{doc_id}_chunk_{i}"
+                for i in range(max(chunk_idx - context_before, 0), chunk_idx + context_after + 1)
+            ])
+        
+        context_ids = list(dict.fromkeys(cid for _, ids in windows.values() for cid in ids))
+        doc_ids = list(dict.fromkeys(doc_id for doc_id, _ in windows.values()))
+        
+        contents, documents = await asyncio.gather(
+            store.get_chunk_contents(context_ids),
+            store.get_documents_with_links(doc_ids)
         )
-        doc_row = await cursor.fetchone()
         
-        if not doc_row:
-            return None
+        # 解析时间（每个文档只解析一次）
+        parsed_times = {
+            doc_id: (_parse_datetime(created), _parse_datetime(modified))
+            for doc_id, (_, _, created, modified, _, _) in documents.items()
+        }
         
-        # 获取标签
-        cursor = await self.indexer.metadata_store.conn.execute(
-            "SELECT tag_name FROM tags WHERE doc_id = ?",
-            (doc_id,)
-        )
-        tags = [row[0] for row in await cursor.fetchall()]
+        results = {}
+        for chunk_id, (doc_id, ids) in windows.items():
+            if chunk_id not in contents or doc_id not in documents:
+                continue
+            file_path, title, _, _, tags, backlinks = documents[doc_id]
+            created_at, modified_at = parsed_times[doc_id]
+            results[chunk_id] = {
+                "content": contents[chunk_id],
+                "file_path": file_path,
+                "title": title,
+                "tags": tags,
+                "backlinks": backlinks,
+                "created_at": created_at,
+                "modified_at": modified_at,
+                # 按 chunk_index 顺序合并上下文内容
+                "extended_content": '\n\n'.join(contents[cid] for cid in ids if cid in contents)
+            }
         
-        # 获取双链
-        cursor = await self.indexer.metadata_store.conn.execute(
-            "SELECT target_page FROM backlinks WHERE source_doc_id = ?",
-            (doc_id,)
-        )
-        backlinks = [row[0] for row in await cursor.fetchall()]
-        
-        # 解析时间
-        from dateutil import parser as date_parser
-        created_at = date_parser.parse(doc_row[3]) if doc_row[3] else None
-        modified_at = date_parser.parse(doc_row[4]) if doc_row[4] else None
-        
-        return {
-            "content": chunk_row[2],
-            "file_path": doc_row[1],
-            "title": doc_row[2],
-            "tags": tags,
-            "backlinks": backlinks,
-            "created_at": created_at,
-            "modified_at": modified_at
-        }
-
+        return results
     
     async def _get_chunk_data_with_context(self, chunk_id: str, 
                                            context_before: int = 3,
                                            context_after: int = 2) -> Dict:
         """
-        获取分块数据并包含上下文
+        获取单个分块数据并包含上下文
         
         Args:
             chunk_id: chunk ID
@@ -265,50 +429,8 @@ class RetrieverService:
         Returns:
             包含 extended_content 的 chunk 数据
         """
-        # 获取当前 chunk 的数据
-        current_chunk = await self._get_chunk_data(chunk_id)
-        if not current_chunk:
-            return None
-        
-        # 解析 doc_id 和 chunk_index
-        doc_id, chunk_idx_str = chunk_id.rsplit('_chunk_', 1)
-        chunk_idx = int(chunk_idx_str)
-        
-        # 获取上下文 chunks
-        context_contents = []
-        
-        # 前面的 chunks
-        for i in range(chunk_idx - context_before, chunk_idx):
-            if i >= 0:
-                ctx_id = f"{doc_id}_chunk_{i}"
-                cursor = await self.indexer.metadata_store.conn.execute(
-                    "SELECT content FROM chunks WHERE chunk_id = ?",
-                    (ctx_id,)
-                )
-                row = await cursor.fetchone()
-                if row:
-                    context_contents.append(row[0])
-        
-        # 当前 chunk
-        context_contents.append(current_chunk['content'])
-        
-        # 后面的 chunks
-        for i in range(chunk_idx + 1, chunk_idx + context_after + 1):
-            ctx_id = f"{doc_id}_chunk_{i}"
-            cursor = await self.indexer.metadata_store.conn.execute(
-                "SELECT content FROM chunks WHERE chunk_id = ?",
-                (ctx_id,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                context_contents.append(row[0])
-            else:
-                break  # 没有更多 chunk 了
-        
-        # 合并内容
-        current_chunk['extended_content'] = '\n\n'.join(context_contents)
-        
-        return current_chunk
+        results = await self._get_chunk_data_batch([chunk_id], context_before, context_after)
+        return results.get(chunk_id)
 
     
     def _calculate_title_boost(self, query: str, title: str) -> float:
@@ -330,54 +452,17 @@ class RetrieverService:
         if not title or not query:
             return 1.0
         
-        # 转小写
-        query_lower = query.lower()
-        title_lower = title.lower()
-        
-        # 停用词
-        stopwords = {'的', '了', '和', '是', '在', '有', '我', '你', '他', '她', '它',
-                     'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
-                     '告诉', '笔记', '中', '哪些', '相关', '信息', '关于', '有关', '么', '吗'}
-        
-        # 提取关键词：分割成单词和字符
-        query_keywords = set()
-        
-        # 1. 按空格/标点分割（处理英文单词）
-        import re
-        tokens = re.split(r'[\s，。！？、]+', query_lower)
-        
-        for token in tokens:
-            token = token.strip()
-            if not token:
-                continue
-            
-            # 如果是英文单词（长度>=2）
-            if token.isascii() and len(token) >= 2:
-                if token not in stopwords:
-                    query_keywords.add(token)
-            # 如果包含中文，提取2字词和3字词
-            else:
-                # 提取连续的非停用词中文片段
-                for i in range(len(token)):
-                    # 2字词
-                    if i + 2 <= len(token):
-                        word = token[i:i+2]
-                        if word not in stopwords and not word.isascii():
-                            query_keywords.add(word)
-                    # 3字词
-                    if i + 3 <= len(token):
-                        word = token[i:i+3]
-                        if word not in stopwords and not word.isascii():
-                            query_keywords.add(word)
-        
+        # 查询关键词按查询缓存，同一查询的多个候选只分词一次
+        query_keywords, automaton = _query_matcher(query)
         if not query_keywords:
             return 1.0
         
-        # 计算匹配度
-        matched_count = 0
-        for keyword in query_keywords:
-            if keyword in title_lower:
-                matched_count += 1
+        # 计算匹配度：自动机单遍扫描标题，否则逐个关键词子串查找
+        title_lower = title.lower()
+        if automaton is not None:
+            matched_count = len({keyword for _, keyword in automaton.iter(title_lower)})
+        else:
+            matched_count = sum(1 for keyword in query_keywords if keyword in title_lower)
         
         # 计算覆盖率
         coverage = matched_count / len(query_keywords)
@@ -393,12 +478,13 @@ class RetrieverService:
         
         return boost
     
-    def _calculate_time_decay(self, modified_at) -> float:
+    def _calculate_time_decay(self, modified_at, now: datetime) -> float:
         """
         计算时间衰减权重
         
         Args:
             modified_at: 修改时间
+            now: 当前时间（同一次检索的所有候选共用）
         
         Returns:
             权重倍数
@@ -406,15 +492,14 @@ class RetrieverService:
         if not modified_at:
             return 1.0
         
-        now = datetime.now()
         delta = now - modified_at
         
         # 近期（3个月内）：权重 × 1.5
-        if delta < timedelta(days=self.time_decay_config.recent_months * 30):
+        if delta < self._recent_window:
             return self.time_decay_config.recent_boost
         
         # 旧文档（1年前）：权重 × 0.8
-        if delta > timedelta(days=self.time_decay_config.old_years * 365):
+        if delta > self._old_window:
             return self.time_decay_config.old_penalty
         
         # 中间时期：线性衰减
@@ -422,40 +507,42 @@ class RetrieverService:
     
     async def format_answer(self, query: str, results: List[SearchResult]):
         """
-        流式生成答案（手动分块）
+        流式生成答案
         
         Args:
             query: 用户问题
             results: 检索结果列表
         
         Yields:
-            str: 文本片段（按字符分块）
+            str: LLM 流式返回的文本片段
         """
-        # 转换结果为字典格式
-        local_dicts = [r.to_dict() for r in results if r.source == 'local']
-        web_dicts = [r.to_dict() for r in results if r.source == 'web']
+        # 转换为 LLM 服务所需的字典（提示词只用到标题与正文）
+        local_dicts = [{"title": r.title, "content": r.content} for r in results if r.source == 'local']
+        web_dicts = [{"title": r.title, "content": r.content} for r in results if r.source == 'web']
         
         logger.info(f"🎨 开始生成答案: 本地结果={len(local_dicts)}条, 网络结果={len(web_dicts)}条")
         
-        # 调用非流式 LLM API 获取完整答案
+        # 命中答案缓存时直接返回，无需再次调用 LLM
+        cache_key = self._answer_cache_key(query, results)
+        cached_answer = self._answer_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info(f"💾 答案缓存命中 (长度={len(cached_answer)}字符)")
+            yield cached_answer
+            return
+        
+        # 直接转发 LLM 流式输出，生成一段发送一段
         try:
-            answer = await self.llm.generate_answer(query, local_dicts, web_dicts)
-            
-            logger.info(f"📝 答案生成完成，开始流式分块发送 (总长度={len(answer)}字符)")
-            
-            # 手动分块发送（每次 10 个字符）
-            chunk_size = 10
-            total_chunks = (len(answer) + chunk_size - 1) // chunk_size
-            
-            for i in range(0, len(answer), chunk_size):
-                chunk = answer[i:i + chunk_size]
-                chunk_num = i // chunk_size + 1
-                logger.debug(f"📤 发送分块 {chunk_num}/{total_chunks}: {len(chunk)}字符")
+            parts = []
+            async for chunk in self.llm.stream_answer(query, local_dicts, web_dicts):
+                parts.append(chunk)
                 yield chunk
-                # 稍微延迟以模拟流式效果
-                await asyncio.sleep(0.05)
             
-            logger.info(f"✅ 流式答案发送完成 ({total_chunks}个分块)")
+            answer = ''.join(parts)
+            logger.info(f"✅ 流式答案发送完成 (总长度={len(answer)}字符)")
+            
+            # 仅缓存完整生成成功的答案（降级答案不缓存）
+            if answer and len(answer) <= self.ANSWER_CACHE_MAX_CHARS:
+                self._answer_cache[cache_key] = answer
         
         except Exception as e:
             logger.error(f"❌ 答案生成失败: {str(e)}")
@@ -476,8 +563,8 @@ class RetrieverService:
         Returns:
             引用列表（同一文件只保留得分最高的）
         """
-        # 按 file_path 分组，保留每个文件得分最高的结果
-        file_map = {}  # file_path -> (result, max_score)
+        # 按 file_path 分组，保留每个文件得分最高的结果（每条结果一次字典查找）
+        file_map: Dict[str, SearchResult] = {}
         
         for result in results:
             # 网络结果使用 URL 作为唯一标识
@@ -487,11 +574,12 @@ class RetrieverService:
                 continue
             
             # 如果是新文件，或分数更高，则更新
-            if key not in file_map or result.score > file_map[key][1]:
-                file_map[key] = (result, result.score)
+            current = file_map.get(key)
+            if current is None or result.score > current.score:
+                file_map[key] = result
         
-        # 按原始顺序排序（保持得分顺序）
-        unique_results = [item[0] for item in sorted(file_map.values(), key=lambda x: x[1], reverse=True)]
+        # 按得分降序排列（同分保持首次出现顺序）
+        unique_results = sorted(file_map.values(), key=attrgetter('score'), reverse=True)
         
         # 构建引用
         citations = []
@@ -3,30 +3,100 @@
 使用 DuckDuckGo API (新版 ddgs SDK)
 """
 import asyncio
-from typing import List, Dict
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Dict, Optional
 from datetime import datetime
 
+import httpx
+from bs4 import BeautifulSoup
+from cachetools import TTLCache
+from ddgs import DDGS
+
 try:
-    from ddgs import DDGS
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_ENABLED = True
 except ImportError:
-    # 兼容旧包名
-    try:
-        from duckduckgo_search import DDGS
-    except ImportError:
-        from duckduckgo_search import AsyncDDGS as DDGS
+    HTTP2_ENABLED = False
 
-import httpx
-from bs4 import BeautifulSoup
+try:
+    import lxml  # noqa: F401  C 实现的 HTML 解析器，比 html.parser 快数倍
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+try:
+    # 只提取文本时不需要 BeautifulSoup 的 Python 对象树，selectolax（lexbor，C 实现）快一个数量级
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
 from config import logger, settings
 
+_WHITESPACE_RE = re.compile(r'\s+')
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w-]+)', re.IGNORECASE)
+
+# 每次搜索同时查询的区域，各占 DDGS 线程池中的一个线程
+SEARCH_REGIONS = ("wt-wt", "us-en")
+# 预期同时进行的搜索数（线程中已开始的查询无法取消，每次搜索会占满各区域的线程直至返回）
+MAX_CONCURRENT_SEARCHES = 4
+
+# DDGS 同步调用专用线程池：与默认执行器隔离，并发请求时不占用其他阻塞任务的线程
+_DDGS_POOL = ThreadPoolExecutor(
+    max_workers=len(SEARCH_REGIONS) * MAX_CONCURRENT_SEARCHES,
+    thread_name_prefix="ddgs"
+)
+_ddgs_local = threading.local()
+
+
+def _thread_ddgs() -> DDGS:
+    """
+    获取当前线程的 DDGS 实例
+    
+    DDGS 内部的引擎缓存与 HTTP 会话不是线程安全的，各区域并发查询时不能共用一个实例；
+    线程池中的线程长期存在，每个线程的实例随线程复用，免去每次查询重新构建
+    """
+    ddgs = getattr(_ddgs_local, "ddgs", None)
+    if ddgs is None:
+        ddgs = _ddgs_local.ddgs = DDGS()
+    return ddgs
+
 
 class WebSearchService:
     """网络搜索服务"""
     
+    MAX_CONCURRENT_FETCHES = 8
+    MAX_FETCH_BYTES = 512_000  # 单个页面最多读取的字节数，正文提取只需页面前部
+    MAX_CONTENT_LENGTH = 2_000_000  # Content-Length 超过该值的页面不下载
+    HTML_CONTENT_TYPES = ("text/html", "application/xhtml")
+    # 搜索结果缓存：DDGS 调用慢且有频率限制，相同查询短时间内直接复用
+    SEARCH_CACHE_SIZE = 256
+    SEARCH_CACHE_TTL = 300
+    # 页面正文缓存：按 URL 缓存提取后的文本（已截断至 max_content_length，内存占用小）
+    PAGE_CACHE_SIZE = 1024
+    PAGE_CACHE_TTL = 3600
+    
     def __init__(self):
         self.cache_dir = settings.storage.cache_dir
         self.max_content_length = 1000  # 网页内容最大长度
+        
+        # 所有网页抓取共用一个客户端，跨结果、跨查询复用连接（免去每次 TCP + TLS 握手）
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            follow_redirects=True,
+            http2=HTTP2_ENABLED
+        )
+        # 限制同时抓取的页面数，避免突发并发触发对端限流后反复失败重试
+        self._fetch_sem = asyncio.Semaphore(self.MAX_CONCURRENT_FETCHES)
+        
+        self._search_cache = TTLCache(maxsize=self.SEARCH_CACHE_SIZE, ttl=self.SEARCH_CACHE_TTL)
+        self._page_cache = TTLCache(maxsize=self.PAGE_CACHE_SIZE, ttl=self.PAGE_CACHE_TTL)
+    
+    async def close(self):
+        """关闭 HTTP 客户端"""
+        await self._client.aclose()
     
     async def search(self, query: str, max_results: int = 5) -> List[Dict]:
         """
@@ -51,15 +121,16 @@ class WebSearchService:
             
             logger.info(f"🌐 开始网络搜索: {query}")
             
-            # 使用新版 DDGS API（同步转异步）
-            results = await self._ddgs_search(query, max_results)
+            # 搜索结果一返回即逐条开始抓取页面
+            tasks = [
+                asyncio.create_task(self._fetch_content(item))
+                async for item in self._ddgs_search(query, max_results)
+            ]
             
-            if not results:
+            if not tasks:
                 logger.warning(f"网络搜索无结果: {query}")
                 return []
             
-            # 抓取页面内容（并发）
-            tasks = [self._fetch_content(item) for item in results]
             results = await asyncio.gather(*tasks)
             
             logger.info(f"✅ 网络搜索完成，返回 {len(results)} 条结果")
@@ -69,70 +140,79 @@ class WebSearchService:
             logger.error(f"❌ 网络搜索失败: {str(e)}")
             return []
     
-    async def _ddgs_search(self, query: str, max_results: int) -> List[Dict]:
+    async def _ddgs_search(self, query: str, max_results: int) -> AsyncIterator[Dict]:
         """
-        调用 DuckDuckGo 搜索（同步 API 转异步）
+        调用 DuckDuckGo 搜索（各区域在线程池中并发查询，采用最先返回的非空结果）
         
         Args:
             query: 搜索查询
             max_results: 最大结果数
         
+        Yields:
+            搜索结果项（每次产出新的字典，调用方可直接修改）
+        """
+        key = (query, max_results)
+        results = self._search_cache.get(key)
+        if results is not None:
+            logger.debug(f"命中搜索结果缓存: {query}")
+        else:
+            results = await self._search_regions(query, max_results)
+            # 空结果可能是临时失败（限流等），不缓存
+            if results:
+                self._search_cache[key] = results
+        
+        for item in results:
+            yield dict(item)
+    
+    async def _search_regions(self, query: str, max_results: int) -> List[Dict]:
+        """
+        全球与美国区域同时查询，返回最先完成的非空结果（原先全球无结果时才串行查询美国区域）
+        
         Returns:
-            搜索结果列表
+            搜索结果列表；各区域均无结果时返回空列表
         """
-        def _sync_search():
-            """同步搜索逻辑"""
-            results = []
-            
-            try:
-                # 尝试全球搜索
-                with DDGS() as ddgs:
-                    search_results = ddgs.text(
-                        query,
-                        max_results=max_results,
-                        region="wt-wt",
-                        safesearch="moderate"
-                    )
-                    
-                    # ddgs.text() 返回生成器，需要转为列表
-                    for result in search_results:
-                        results.append({
-                            "title": result.get("title", ""),
-                            "url": result.get("href", ""),
-                            "snippet": result.get("body", ""),
-                            "source": "web",
-                            "fetched_at": datetime.now().isoformat()
-                        })
-                
-                # 如果无结果，尝试美国区域
-                if not results:
-                    with DDGS() as ddgs:
-                        search_results = ddgs.text(
-                            query,
-                            max_results=max_results,
-                            region="us-en",
-                            safesearch="moderate"
-                        )
-                        
-                        for result in search_results:
-                            results.append({
-                                "title": result.get("title", ""),
-                                "url": result.get("href", ""),
-                                "snippet": result.get("body", ""),
-                                "source": "web",
-                                "fetched_at": datetime.now().isoformat()
-                            })
-            
-            except Exception as e:
-                logger.error(f"DuckDuckGo 搜索异常: {str(e)}")
+        loop = asyncio.get_running_loop()
+        # 在专用线程池中运行同步代码（避免阻塞异步事件循环）
+        futures = [
+            loop.run_in_executor(_DDGS_POOL, self._sync_search, query, max_results, region)
+            for region in SEARCH_REGIONS
+        ]
+        try:
+            for next_done in asyncio.as_completed(futures):
+                results = await next_done
+                if results:
+                    return results
+            return []
+        finally:
+            # 已取得结果后不再等待其余区域（线程中已开始的请求无法中断，结果直接丢弃）
+            for future in futures:
+                future.cancel()
+    
+    def _sync_search(self, query: str, max_results: int, region: str) -> List[Dict]:
+        """同步搜索单个区域（异常时记录日志并返回空列表）"""
+        try:
+            search_results = _thread_ddgs().text(
+                query,
+                max_results=max_results,
+                region=region,
+                safesearch="moderate"
+            )
             
-            return results
-        
-        # 在线程池中运行同步代码（避免阻塞异步事件循环）
-        loop = asyncio.get_event_loop()
-        results = await loop.run_in_executor(None, _sync_search)
+            fetched_at = datetime.now().isoformat()
+            return [
+                {
+                    "title": result.get("title", ""),
+                    "url": result.get("href", ""),
+                    "snippet": result.get("body", ""),
+                    "source": "web",
+                    "fetched_at": fetched_at
+                }
+                for result in search_results
+            ]
         
-        return results
+        except Exception as e:
+            logger.error(f"DuckDuckGo 搜索异常 ({region}): {str(e)}")
+            return []
     
     async def _fetch_content(self, item: Dict) -> Dict:
         """
@@ -144,32 +224,39 @@ class WebSearchService:
         Returns:
             补充了 content 字段的结果
         """
+        cached = self._page_cache.get(item["url"])
+        if cached is not None:
+            item["content"] = cached
+            return item
+        
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(item["url"])
-                response.raise_for_status()
-                
-                # 解析 HTML
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # 移除脚本和样式
-                for script in soup(["script", "style"]):
-                    script.decompose()
-                
-                # 提取文本
-                text = soup.get_text()
-                
-                # 清理文本
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                text = ' '.join(chunk for chunk in chunks if chunk)
-                
-                # 截断内容
-                if len(text) > self.max_content_length:
-                    text = text[:self.max_content_length] + "..."
-                
-                item["content"] = text
-                logger.debug(f"✅ 抓取成功: {item['url']}")
+            async with self._fetch_sem:
+                # 流式读取并在达到上限时停止，超大页面（内嵌 base64 图片等）不再整体载入内存
+                async with self._client.stream("GET", item["url"]) as response:
+                    response.raise_for_status()
+                    
+                    # 读取正文前按响应头过滤：非 HTML（PDF、视频等）或声明体积过大的页面直接使用 snippet
+                    skip_reason = self._skip_reason(response.headers)
+                    if skip_reason:
+                        logger.debug(f"跳过抓取 {item['url']}: {skip_reason}")
+                        item["content"] = item.get("snippet", "")
+                        return item
+                    
+                    body = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        body += chunk
+                        if len(body) >= self.MAX_FETCH_BYTES:
+                            break
+                    encoding = response.charset_encoding
+            
+            # 解析与清理放到线程中执行，避免数十毫秒的 CPU 解析阻塞事件循环上的其他请求
+            text = await asyncio.to_thread(
+                self._parse_html, bytes(body[:self.MAX_FETCH_BYTES]), encoding, self.max_content_length
+            )
+            
+            item["content"] = text
+            self._page_cache[item["url"]] = text
+            logger.debug(f"✅ 抓取成功: {item['url']}")
         
         except Exception as e:
             logger.warning(f"⚠️ 抓取失败 {item['url']}: {str(e)}")
@@ -177,6 +264,69 @@ class WebSearchService:
             item["content"] = item.get("snippet", "")
         
         return item
+    
+    @classmethod
+    def _skip_reason(cls, headers: httpx.Headers) -> Optional[str]:
+        """根据响应头判断是否跳过下载正文，返回跳过原因（缺少相应头时不跳过）"""
+        content_type = headers.get("content-type", "").strip().lower()
+        if content_type and not content_type.startswith(cls.HTML_CONTENT_TYPES):
+            return f"非 HTML 内容 ({content_type})"
+        
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > cls.MAX_CONTENT_LENGTH:
+            return f"页面过大 ({content_length} 字节)"
+        
+        return None
+    
+    @classmethod
+    def _parse_html(cls, content: bytes, encoding: Optional[str], max_length: int) -> str:
+        """
+        提取网页纯文本并折叠空白、截断到 max_length（同步 CPU 任务，在线程中调用）
+        """
+        text = cls._extract_text(content, encoding)
+        
+        # 先粗截断（留出空白折叠的余量），限制超大页面上的正则处理量
+        raw_limit = max_length * 4
+        truncated = len(text) > raw_limit
+        
+        # 清理文本：连续空白折叠为单个空格（单个正则在 C 层完成）
+        text = _WHITESPACE_RE.sub(' ', text[:raw_limit]).strip()
+        
+        # 截断内容
+        if len(text) > max_length:
+            text = text[:max_length] + "..."
+        elif truncated:
+            text += "..."
+        
+        return text
+    
+    @staticmethod
+    def _extract_text(content: bytes, encoding: Optional[str]) -> str:
+        """
+        提取网页纯文本（移除脚本和样式）
+        
+        优先使用 selectolax；未安装或解析失败时退回 BeautifulSoup
+        """
+        if LexborHTMLParser is not None:
+            try:
+                # lexbor 不做编码探测：按响应头或 <meta charset> 声明的编码解码，默认 UTF-8
+                if not encoding:
+                    match = _META_CHARSET_RE.search(content, 0, 2048)
+                    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+                tree = LexborHTMLParser(content.decode(encoding, errors='replace'))
+                tree.strip_tags(["script", "style"])
+                return tree.root.text() if tree.root else ""
+            except Exception as e:
+                logger.debug(f"selectolax 解析失败，退回 BeautifulSoup: {e!r}")
+        
+        # 解析 HTML（直接传入 bytes，编码取自响应头或由解析器探测，省去一次 str 解码）
+        soup = BeautifulSoup(content, HTML_PARSER, from_encoding=encoding)
+        
+        # 移除脚本和样式
+        for script in soup(["script", "style"]):
+            script.decompose()
+        
+        return soup.get_text()
 
 
 # 测试代码
@@ -195,6 +345,8 @@ async def test_web_search():
         print(f"   URL: {result['url']}")
         print(f"   内容: {result['content'][:100]}...")
         print()
+    
+    await service.close()
 
 
 if __name__ == "__main__":
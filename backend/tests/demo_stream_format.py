@@ -1,8 +1,25 @@
 """
 演示优化后的流式输出格式
 """
-import json
 import re
+import sys
+
+import orjson
+
+# 句子分割模式（保留标点符号），模块加载时编译一次
+_SPLIT_RE = re.compile(r'([。！？\n]+|[.!?]+\s+)')
+
+
+# SSE 帧前后缀（与 main.py 一致，预编码为 bytes）
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+
+def emit_event(payload: dict):
+    """序列化为一帧 SSE 并直接写出 bytes（orjson 输出即为合法 JSON，无需再校验）"""
+    sys.stdout.flush()  # 先冲刷 print 的文本缓冲，保证输出顺序
+    sys.stdout.buffer.write(SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX)
+    sys.stdout.buffer.flush()
 
 
 def demo_optimized_stream():
@@ -43,17 +60,15 @@ git worktree list
     print()
     
     # 按句子分割（保留标点符号）
-    sentences = re.split(r'([。！？\n]+|[.!?]+\s+)', sample_answer)
+    sentences = _SPLIT_RE.split(sample_answer)
     buffer = ""
     chunk_count = 0
     
     print("🔄 开始模拟流式输出...\n")
     
     # 工具调用事件
-    print('data: {"type": "tool_call", "tool": "local_search", "status": "running"}')
-    print()
-    print('data: {"type": "tool_call", "tool": "local_search", "status": "completed", "count": 10}')
-    print()
+    emit_event({"type": "tool_call", "tool": "local_search", "status": "running"})
+    emit_event({"type": "tool_call", "tool": "local_search", "status": "completed", "count": 10})
     
     # 文本流式输出
     for i, part in enumerate(sentences):
@@ -63,55 +78,24 @@ git worktree list
         if (i % 2 == 1 and buffer.strip()) or len(buffer) > 100:
             chunk_count += 1
             
-            # 转义 JSON 中的特殊字符
-            escaped_content = (buffer
-                .replace('\\', '\\\\')
-                .replace('"', '\\"')
-                .replace('\n', '\\n')
-                .replace('\r', '\\r')
-                .replace('\t', '\\t'))
-            
-            # 构造 SSE 事件
-            event_json = f'{{"type": "text", "content": "{escaped_content}"}}'
-            
-            # 验证 JSON 格式
-            try:
-                json.loads(event_json)
-                print(f'data: {event_json}')
-                print()
-            except json.JSONDecodeError as e:
-                print(f"❌ JSON 错误: {e}")
-                print(f"   内容: {event_json[:100]}...")
-                print()
+            emit_event({"type": "text", "content": buffer})
             
             buffer = ""
     
     # 发送剩余内容
     if buffer.strip():
         chunk_count += 1
-        escaped_content = (buffer
-            .replace('\\', '\\\\')
-            .replace('"', '\\"')
-            .replace('\n', '\\n')
-            .replace('\r', '\\r')
-            .replace('\t', '\\t'))
-        
-        event_json = f'{{"type": "text", "content": "{escaped_content}"}}'
-        print(f'data: {event_json}')
-        print()
+        emit_event({"type": "text", "content": buffer})
     
     # 引用数据
     citations = [
         {"id": 1, "title": "git worktree", "source": "local", "file_path": "/path/to/note.md"},
         {"id": 2, "title": "Git Advanced", "source": "local", "file_path": "/path/to/note2.md"}
     ]
-    citations_json = json.dumps(citations, ensure_ascii=False)
-    print(f'data: {{"type": "citations", "data": {citations_json}}}')
-    print()
+    emit_event({"type": "citations", "data": citations})
     
     # 完成标记
-    print('data: {"type": "done"}')
-    print()
+    emit_event({"type": "done"})
     
     # 统计信息
     print("=" * 70)
@@ -2,6 +2,7 @@
 测试优化后的流式输出
 """
 import asyncio
+import os
 import sys
 from pathlib import Path
 
@@ -9,8 +10,27 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent))
 
 import httpx
+import orjson
 from main import app
-import json
+
+SSE_DATA_PREFIX = b"data: "
+
+
+def iter_sse_data(response: httpx.Response, chunk_size: int = 16384):
+    """
+    按行切分 SSE 字节流，逐个产出 data 负载（bytes）
+    
+    直接在 16KB 字节块上 split，不为每一行构造 str（服务端会合并多帧写出，一个块内常含多个事件）
+    """
+    buffer = b""
+    for chunk in response.iter_bytes(chunk_size=chunk_size):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.startswith(SSE_DATA_PREFIX):
+                yield line[len(SSE_DATA_PREFIX):]
+    if buffer.startswith(SSE_DATA_PREFIX):
+        yield buffer[len(SSE_DATA_PREFIX):]
 
 
 def test_stream_output():
@@ -19,19 +39,25 @@ def test_stream_output():
     print("测试优化后的流式输出格式")
     print("=" * 60)
     
-    # 使用 httpx 直接测试，因为需要实际启动服务
-    # 这里改为手动测试说明
+    # 需要实际启动服务：设置 STREAM_TEST_BASE_URL（如 http://localhost:8000）后直接请求该服务
+    base_url = os.getenv("STREAM_TEST_BASE_URL")
+    if base_url:
+        return check_live_stream(base_url)
+    
+    # 未指定服务地址时只输出手动测试说明
     print("\n⚠️  注意：此测试需要手动运行服务")
     print("\n请执行以下步骤：")
     print("1. 在终端 1 运行: cd backend && python main.py")
-    print("2. 在终端 2 运行: curl -N http://localhost:8000/api/chat?query=如何使用git+worktree&local_ratio=0.8")
+    print("2. 在终端 2 运行: STREAM_TEST_BASE_URL=http://localhost:8000 python tests/test_stream_output.py")
+    print("   或: curl -N http://localhost:8000/api/chat?query=如何使用git+worktree&local_ratio=0.8")
     print("\n或者使用前端界面直接测试\n")
     
     return True
-    
-    # 以下是原测试代码（需要服务运行）
-    """
-    client = httpx.Client(base_url="http://localhost:8000")
+
+
+def check_live_stream(base_url: str) -> bool:
+    """请求运行中的服务，逐个解析 SSE 事件并校验格式"""
+    client = httpx.Client(base_url=base_url, timeout=None)
     
     # 发起流式请求
     query = "如何使用 git worktree？"
@@ -43,8 +69,8 @@ def test_stream_output():
         print(f"📋 Content-Type: {response.headers.get('content-type')}\n")
         
         if response.status_code != 200:
-            print(f"❌ 请求失败: {response.text}")
-            return
+            print(f"❌ 请求失败: {response.read().decode('utf-8', 'replace')}")
+            return False
         
         event_count = 0
         text_chunks = []
@@ -52,19 +78,14 @@ def test_stream_output():
         done_received = False
         json_errors = []
         
-        # 逐行读取流式响应
-        for line in response.iter_lines():
-            if not line or not line.strip():
-                continue
-            
-            # 解析 SSE 格式
-            if line.startswith("data: "):
+        # 按字节块读取流式响应并切分出 SSE 事件
+        for data_bytes in iter_sse_data(response):
+            if data_bytes.strip():
                 event_count += 1
-                data_str = line[6:]  # 移除 "data: " 前缀
                 
                 try:
-                    # 尝试解析 JSON
-                    data = json.loads(data_str)
+                    # 尝试解析 JSON（orjson 直接解析 bytes）
+                    data = orjson.loads(data_bytes)
                     event_type = data.get("type")
                     
                     if event_type == "tool_call":
@@ -87,14 +108,15 @@ def test_stream_output():
                         done_received = True
                         print(f"✅ 完成标记")
                 
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
+                    data_str = data_bytes[:100].decode("utf-8", "replace")
                     json_errors.append({
                         "event": event_count,
                         "error": str(e),
-                        "data": data_str[:100]
+                        "data": data_str
                     })
                     print(f"❌ JSON 解析错误 (事件 #{event_count}): {str(e)}")
-                    print(f"   数据: {data_str[:100]}...")
+                    print(f"   数据: {data_str}...")
         
         # 输出统计
         print("\n" + "=" * 60)
@@ -2,20 +2,76 @@
 Markdown 解析器
 支持 Logseq 双链语法和标签提取
 """
+import os
 import re
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Union
 
 import frontmatter
+from cachetools import LRUCache
+
+# parse_file 结果缓存：键为 (路径, mtime_ns, 文件大小)，文件未变化时重建索引不再重复读取和解析 frontmatter
+# （解析在线程池中并发执行，LRUCache 的读写都会调整内部顺序，需加锁）
+PARSE_CACHE_SIZE = 4096
+_parse_cache: LRUCache = LRUCache(maxsize=PARSE_CACHE_SIZE)
+_parse_cache_lock = threading.Lock()
+
+
+def _compile_possessive(pattern: str) -> re.Pattern:
+    """
+    编译含占有量词（++）的模式：字符类后紧跟它所排除的字面量时，回退到更短的匹配不可能成功，
+    占有量词让匹配失败时直接放弃，不再逐字符回退（未闭合的 [ [[ ` * 大量出现时差距明显）。
+    Python 3.10 不支持该语法，退回普通量词，匹配结果相同
+    """
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return re.compile(pattern.replace('++', '+'))
 
 
 class MarkdownParser:
     """Markdown 文档解析器"""
     
     # 正则表达式
-    BACKLINK_PATTERN = re.compile(r'\[\[([^\]]+)\]\]')  # [[页面名]]
-    TAG_PATTERN = re.compile(r'(?:^|\s)#([a-zA-Z0-9_\u4e00-\u9fa5]+)')  # #标签
+    BACKLINK_PATTERN = _compile_possessive(r'\[\[([^\]]++)\]\]')  # [[页面名]]
+    # #标签：# 位于文本开头或空白之后。写成「字面量 # + 反向断言」而非 (?:^|\s)#，
+    # 正则引擎按字面量快速定位候选位置，不必在每个字符处尝试 ^ 与 \s（findall 结果不变）
+    TAG_PATTERN = re.compile(r'#(?<!\S#)([a-zA-Z0-9_\u4e00-\u9fa5]+)')
+    # 双链与标签合并为一个交替模式，scan() 单次遍历同时提取
+    # （[[...]] 内的 # 属于页面名，不计为标签）
+    LINK_TAG_PATTERN = _compile_possessive(
+        r'\[\[([^\]]++)\]\]|#(?<!\S#)([a-zA-Z0-9_\u4e00-\u9fa5]+)'
+    )
+    
+    # 段落：不含空行（\n\n）的最长片段，首尾为非空白字符（等价于 split('\n\n') 后 strip 的结果）
+    PARAGRAPH_PATTERN = re.compile(r'\S(?:[^\n]*(?:\n(?!\n)[^\n]*)*\S)?')
+    
+    # 句子分隔符：_split_large_text 在窗口内取位置最靠后的一个（不同分隔符不会落在同一位置，无需优先级）
+    SENTENCE_DELIMITERS = ('。', '！', '？', '\n\n', '.', '!', '?')
+    
+    # clean_content 的替换规则（预编译，按顺序执行）：(模式, 替换, 必需字符)
+    # 文本中不含必需字符时该规则不可能匹配，直接跳过（单字符 in 检查由 memchr 完成，几乎无开销，
+    # 纯文本段落省去大部分正则调用）；每条规则执行前对当前文本检查，结果与逐条执行完全一致
+    # 行首规则写成「字面量开头 + 反向断言」：(?<!.X) 中 . 不匹配换行，即 X 位于文本开头或换行之后，
+    # 与 ^X（MULTILINE）等价，但正则引擎可按字面量快速定位候选位置，无需在每个字符处尝试
+    CLEAN_RULES = [
+        (re.compile(r'```[\s\S]*?```'), '', '`'),                       # 代码块
+        (_compile_possessive(r'`[^`]++`'), '', '`'),                    # 行内代码
+        (re.compile(r'!\[.*?\]\(.*?\)'), '', '!'),                      # 图片
+        (_compile_possessive(r'\[([^\]]++)\]\([^\)]++\)'), r'\1', ']'),  # 链接（保留文本）
+        (_compile_possessive(r'\[\[([^\]]++)\]\]'), r'\1', '['),        # 双链标记（保留文本）
+        (re.compile(r'#(?<!.#)#{0,5}\s+'), '', '#'),                    # 标题标记（行首 #{1,6}）
+        (_compile_possessive(r'\*\*([^\*]++)\*\*'), r'\1', '*'),        # 加粗
+        (_compile_possessive(r'\*([^\*]++)\*'), r'\1', '*'),            # 斜体
+        (re.compile(r'>(?<!.>)\s+'), '', '>'),                          # 引用标记（行首 >）
+        (re.compile(r'^\s*[-*+]\s+', re.MULTILINE), '', None),          # 无序列表标记
+        (re.compile(r'^\s*\d+\.\s+', re.MULTILINE), '', '.'),           # 有序列表标记
+        (re.compile(r'\n\n\n+'), '\n\n', None),                         # 多余空行（3 个及以上换行）
+    ]
     
     @staticmethod
     def parse_file(file_path: Path) -> Tuple[str, Dict]:
@@ -23,17 +79,36 @@ class MarkdownParser:
         解析 Markdown 文件
         
         Returns:
-            (content, metadata) 元组
+            (content, metadata) 元组（metadata 每次返回新的字典，调用方可直接修改）
         """
-        with open(file_path, 'r', encoding='utf-8') as f:
-            post = frontmatter.load(f)
+        stat = file_path.stat()
+        key = (str(file_path), stat.st_mtime_ns, stat.st_size)
+        with _parse_cache_lock:
+            cached = _parse_cache.get(key)
+        if cached is not None:
+            content, metadata = cached
+            return content, dict(metadata)
+        
+        content, metadata = MarkdownParser._parse_uncached(file_path, stat)
+        with _parse_cache_lock:
+            _parse_cache[key] = (content, metadata)
+        return content, dict(metadata)
+    
+    @staticmethod
+    def _parse_uncached(file_path: Path, stat: os.stat_result) -> Tuple[str, Dict]:
+        """读取并解析文件（不经过缓存；可被子进程 pickle 调用）"""
+        # 一次读入字节后整体解码，省去文本模式 TextIOWrapper 的分块增量解码；
+        # 换行符按文本模式（通用换行）的规则手动统一
+        text = file_path.read_bytes().decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        post = frontmatter.loads(text)
         
         # 提取元数据
         metadata = dict(post.metadata)
         content = post.content
         
         # 提取文件时间
-        stat = file_path.stat()
         metadata['created_at'] = datetime.fromtimestamp(stat.st_ctime)
         metadata['modified_at'] = datetime.fromtimestamp(stat.st_mtime)
         
@@ -43,6 +118,59 @@ class MarkdownParser:
         
         return content, metadata
     
+    @staticmethod
+    def _parse_uncached_safe(file_path: Path, stat: os.stat_result) -> Union[Tuple[str, Dict], Exception]:
+        """子进程入口：失败时返回异常对象而不是抛出，避免单个文件中断整批"""
+        try:
+            return MarkdownParser._parse_uncached(file_path, stat)
+        except Exception as e:
+            return e
+    
+    @staticmethod
+    def parse_files(paths: List[Path]) -> List[Union[Tuple[str, Dict], Exception]]:
+        """
+        多进程批量解析（首次导入大量笔记时使用，frontmatter 的 YAML 解析与正则均为纯 Python，线程受 GIL 限制）
+        
+        stat 与缓存查询在主进程完成，只把未命中的文件分发到子进程，解析结果写回主进程的缓存，
+        之后的 parse_file 调用直接命中
+        
+        Returns:
+            与 paths 一一对应的 (content, metadata) 列表，失败项为异常对象
+        """
+        results: List = [None] * len(paths)
+        pending = []
+        for i, file_path in enumerate(paths):
+            try:
+                stat = file_path.stat()
+            except OSError as e:
+                results[i] = e
+                continue
+            key = (str(file_path), stat.st_mtime_ns, stat.st_size)
+            with _parse_cache_lock:
+                cached = _parse_cache.get(key)
+            if cached is not None:
+                results[i] = (cached[0], dict(cached[1]))
+            else:
+                pending.append((i, file_path, stat, key))
+        
+        if pending:
+            # chunksize 合并多个文件为一次进程间通信，摊薄 pickle 与调度开销
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+                parsed = pool.map(
+                    MarkdownParser._parse_uncached_safe,
+                    [file_path for _, file_path, _, _ in pending],
+                    [stat for _, _, stat, _ in pending],
+                    chunksize=16
+                )
+                for (i, _, _, key), result in zip(pending, parsed):
+                    if not isinstance(result, Exception):
+                        with _parse_cache_lock:
+                            _parse_cache[key] = result
+                        result = (result[0], dict(result[1]))
+                    results[i] = result
+        
+        return results
+    
     @staticmethod
     def extract_backlinks(content: str) -> List[str]:
         """
@@ -54,8 +182,8 @@ class MarkdownParser:
         Returns:
             双链列表
         """
-        matches = MarkdownParser.BACKLINK_PATTERN.findall(content)
-        return list(set(matches))  # 去重
+        # 按首次出现顺序去重（结果稳定，与 scan() 一致）
+        return list(map(sys.intern, dict.fromkeys(MarkdownParser.BACKLINK_PATTERN.findall(content))))
     
     @staticmethod
     def extract_tags(content: str) -> List[str]:
@@ -68,8 +196,33 @@ class MarkdownParser:
         Returns:
             标签列表
         """
-        matches = MarkdownParser.TAG_PATTERN.findall(content)
-        return list(set(matches))  # 去重
+        # 按首次出现顺序去重（结果稳定，与 scan() 一致）
+        return list(map(sys.intern, dict.fromkeys(MarkdownParser.TAG_PATTERN.findall(content))))
+    
+    @staticmethod
+    def scan(content: str) -> Tuple[List[str], List[str], str]:
+        """
+        单次遍历提取标签和双链，并清理内容
+        
+        Args:
+            content: 文档内容
+        
+        Returns:
+            (tags, backlinks, clean_content) 元组，标签/双链按首次出现顺序去重
+        """
+        tags, backlinks = {}, {}
+        for backlink, tag in MarkdownParser.LINK_TAG_PATTERN.findall(content):
+            if backlink:
+                backlinks[backlink] = None
+            else:
+                tags[tag] = None
+        
+        # 去重后再驻留：同名标签/双链在所有文档及其分块间共享同一个字符串对象
+        return (
+            list(map(sys.intern, tags)),
+            list(map(sys.intern, backlinks)),
+            MarkdownParser.clean_content(content)
+        )
     
     @staticmethod
     def clean_content(content: str) -> str:
@@ -82,37 +235,9 @@ class MarkdownParser:
         Returns:
             清理后的纯文本
         """
-        # 移除代码块
-        content = re.sub(r'```[\s\S]*?```', '', content)
-        
-        # 移除行内代码
-        content = re.sub(r'`[^`]+`', '', content)
-        
-        # 移除图片
-        content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
-        
-        # 移除链接（保留文本）
-        content = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', content)
-        
-        # 移除双链标记（保留文本）
-        content = re.sub(r'\[\[([^\]]+)\]\]', r'\1', content)
-        
-        # 移除标题标记
-        content = re.sub(r'^#{1,6}\s+', '', content, flags=re.MULTILINE)
-        
-        # 移除加粗/斜体
-        content = re.sub(r'\*\*([^\*]+)\*\*', r'\1', content)
-        content = re.sub(r'\*([^\*]+)\*', r'\1', content)
-        
-        # 移除引用标记
-        content = re.sub(r'^>\s+', '', content, flags=re.MULTILINE)
-        
-        # 移除列表标记
-        content = re.sub(r'^\s*[-*+]\s+', '', content, flags=re.MULTILINE)
-        content = re.sub(r'^\s*\d+\.\s+', '', content, flags=re.MULTILINE)
-        
-        # 移除多余空行
-        content = re.sub(r'\n{3,}', '\n\n', content)
+        for pattern, repl, marker in MarkdownParser.CLEAN_RULES:
+            if marker is None or marker in content:
+                content = pattern.sub(repl, content)
         
         return content.strip()
     
@@ -147,65 +272,48 @@ class MarkdownParser:
             else:
                 return []  # 空内容返回空列表
         
-        # 第一步：按段落分割
-        paragraphs = content.split('\n\n')
-        
-        current_pos = 0
-        accumulated_text = ""
-        accumulated_start = 0
+        # 第一步：按段落遍历（只记录段落在原文中的位置，生成分块时才切片，不复制每个段落）
+        accumulated_start = accumulated_end = None
         
-        for paragraph in paragraphs:
-            paragraph = paragraph.strip()
-            if not paragraph:
-                current_pos += 2  # 跳过 \n\n
-                continue
+        for match in MarkdownParser.PARAGRAPH_PATTERN.finditer(content):
+            start, end = match.span()
             
             # 如果累积文本为空，开始新的累积
-            if not accumulated_text:
-                accumulated_text = paragraph
-                accumulated_start = current_pos
-            else:
-                # 尝试加入当前段落
-                test_text = accumulated_text + '\n\n' + paragraph
+            if accumulated_end is None:
+                accumulated_start, accumulated_end = start, end
+            # 如果加入当前段落后超过目标大小，处理累积的文本
+            elif end - accumulated_start > chunk_size:
+                if accumulated_end - accumulated_start >= min_chunk_size:
+                    chunks.extend(MarkdownParser._emit_chunk(
+                        content[accumulated_start:accumulated_end], accumulated_start,
+                        chunk_size, overlap, min_chunk_size
+                    ))
                 
-                # 如果加入后超过目标大小，处理累积的文本
-                if len(test_text) > chunk_size:
-                    # 处理之前累积的文本
-                    if len(accumulated_text) >= min_chunk_size:
-                        # 如果累积文本过大，需要细分
-                        if len(accumulated_text) > chunk_size * 1.5:
-                            sub_chunks = MarkdownParser._split_large_text(
-                                accumulated_text, accumulated_start, 
-                                chunk_size, overlap, min_chunk_size
-                            )
-                            chunks.extend(sub_chunks)
-                        else:
-                            chunks.append((accumulated_text, accumulated_start, 
-                                         accumulated_start + len(accumulated_text)))
-                    
-                    # 开始新的累积
-                    accumulated_text = paragraph
-                    accumulated_start = current_pos
-                else:
-                    # 继续累积
-                    accumulated_text = test_text
-            
-            current_pos += len(paragraph) + 2  # 包括 \n\n
+                # 开始新的累积
+                accumulated_start, accumulated_end = start, end
+            else:
+                # 继续累积
+                accumulated_end = end
         
         # 处理最后的累积文本
-        if accumulated_text and len(accumulated_text) >= min_chunk_size:
-            if len(accumulated_text) > chunk_size * 1.5:
-                sub_chunks = MarkdownParser._split_large_text(
-                    accumulated_text, accumulated_start, 
-                    chunk_size, overlap, min_chunk_size
-                )
-                chunks.extend(sub_chunks)
-            else:
-                chunks.append((accumulated_text, accumulated_start, 
-                             accumulated_start + len(accumulated_text)))
+        if accumulated_end is not None and accumulated_end - accumulated_start >= min_chunk_size:
+            chunks.extend(MarkdownParser._emit_chunk(
+                content[accumulated_start:accumulated_end], accumulated_start,
+                chunk_size, overlap, min_chunk_size
+            ))
         
         return chunks
     
+    @staticmethod
+    def _emit_chunk(text: str, start_offset: int, chunk_size: int,
+                    overlap: int, min_chunk_size: int) -> List[Tuple[str, int, int]]:
+        """累积文本生成分块：过大（超过 1.5 倍目标大小）时按句子边界细分"""
+        if len(text) > chunk_size * 1.5:
+            return MarkdownParser._split_large_text(
+                text, start_offset, chunk_size, overlap, min_chunk_size
+            )
+        return [(text, start_offset, start_offset + len(text))]
+    
     @staticmethod
     def _split_large_text(text: str, start_offset: int, chunk_size: int, 
                          overlap: int, min_chunk_size: int) -> List[Tuple[str, int, int]]:
@@ -239,10 +347,9 @@ class MarkdownParser:
                 search_start = max(start + min_chunk_size, ideal_end - 200)
                 search_end = ideal_end
                 
-                # 查找最佳分隔符位置
+                # 查找最靠后的句子分隔符（各分隔符一次 C 层反向查找，窗口仅约 200 字符）
                 best_pos = -1
-                # 优先级：中文句号 > 中文标点 > 双换行 > 英文句号
-                for delimiter in ['。', '！', '？', '\n\n', '.', '!', '?']:
+                for delimiter in MarkdownParser.SENTENCE_DELIMITERS:
                     pos = text.rfind(delimiter, search_start, search_end)
                     if pos > best_pos:
                         best_pos = pos
@@ -271,10 +378,11 @@ class MarkdownParser:
                 ))
             
             # 计算下一个起始位置（带重叠）
+            prev_start = start
             start = end - overlap
             
-            # 防止死循环：确保至少前进
-            if start <= (chunks[-1][1] - start_offset if chunks else -1):
+            # 防止死循环：确保至少前进（与本轮起点比较；本轮分块被过滤时也不会回退）
+            if start <= prev_start:
                 start = end
             
             # 如果下一次迭代不会产生足够大的 chunk，直接退出
@@ -287,8 +395,10 @@ class MarkdownParser:
 class LogseqParser(MarkdownParser):
     """Logseq 专用解析器（扩展功能）"""
     
-    @staticmethod
-    def parse_properties(content: str) -> Dict:
+    PROPERTY_PATTERN = re.compile(r'^\s*-\s*(\w+)::\s*(.+)$', re.MULTILINE)  # - key:: value
+    
+    @classmethod
+    def parse_properties(cls, content: str) -> Dict:
         """
         解析 Logseq properties
         
@@ -296,12 +406,7 @@ class LogseqParser(MarkdownParser):
             - property:: value
             - tags:: #tag1 #tag2
         """
-        properties = {}
-        pattern = re.compile(r'^\s*-\s*(\w+)::\s*(.+)$', re.MULTILINE)
-        
-        for match in pattern.finditer(content):
-            key = match.group(1)
-            value = match.group(2).strip()
-            properties[key] = value
-        
-        return properties
+        return {
+            key: value.strip()
+            for key, value in cls.PROPERTY_PATTERN.findall(content)
+        }